@@ -1,12 +1,14 @@
 # main.py
 # To run locally run:
 # uvicorn main:app --reload --host 0.0.0.0 --port 8000 &
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
-from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Request, Query
+from contextlib import asynccontextmanager, suppress
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import text
-from database import engine, get_db, reset_database
+from sqlalchemy.orm import Session, defer
+from sqlalchemy import text, func, case, and_, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import OperationalError
+from database import engine, get_db, reset_database, SessionLocal
 from base import Base
 import models
 from models import User, Teacher, PasswordReset
@@ -17,7 +19,8 @@ from passlib.context import CryptContext
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer
 import shutil
@@ -31,22 +34,84 @@ from bleach.css_sanitizer import CSSSanitizer
 from google.auth.transport import requests
 from google.oauth2 import id_token
 import secrets
+import csv
+import io
+import json
+import re
+import zlib
+import hashlib
+import hmac
+import base64
+import mimetypes
+import difflib
 import random
 from msal import ConfidentialClientApplication  # Add this import
 from sqlalchemy.orm import relationship
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response, JSONResponse
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, unquote
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import time
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are only served as uploaded
+    Image = ImageOps = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     reset_database()
+    housekeeping = [
+        asyncio.create_task(_run_periodically(
+            "Password reset sweep", PASSWORD_RESET_SWEEP_INTERVAL, _run_password_reset_sweep
+        )),
+        asyncio.create_task(_run_periodically(
+            "Activity event compaction", ACTIVITY_COMPACTION_INTERVAL, _run_activity_compaction
+        )),
+        asyncio.create_task(_run_periodically(
+            "Upload session sweep", UPLOAD_SESSION_SWEEP_INTERVAL, _run_upload_session_sweep
+        )),
+    ]
     yield
+    for task in housekeeping:
+        task.cancel()
+    for task in housekeeping:
+        with suppress(asyncio.CancelledError):
+            await task
+    if _image_variant_pool is not None:
+        _image_variant_pool.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def reject_oversize_uploads(request: Request, call_next):
+    """Refuse multipart uploads from their Content-Length, before the form
+    is parsed: Starlette spools the whole body to disk before an endpoint
+    (or its dependencies) runs, so checks there come too late. Registered
+    before CORSMiddleware so the refusals still carry CORS headers."""
+    if request.method == "POST" and request.url.path in UPLOAD_ROUTE_KINDS:
+        content_length = request.headers.get("content-length")
+        if content_length is None or not content_length.isdigit():
+            return JSONResponse(status_code=411, content={"detail": "Content-Length is required for uploads"})
+        kind = UPLOAD_ROUTE_KINDS[request.url.path]
+        max_bytes = UPLOAD_MAX_BYTES[kind] if kind else max(UPLOAD_MAX_BYTES.values())
+        if int(content_length) > max_bytes + UPLOAD_MULTIPART_OVERHEAD:
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content={"detail": f"File is larger than the {max_bytes // (1024 * 1024)} MB upload limit"}
+            )
+        quota_remaining = await asyncio.to_thread(_upload_request_quota, request)
+        if quota_remaining is not None and int(content_length) > max(quota_remaining, 0) + UPLOAD_MULTIPART_OVERHEAD:
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content={"detail": "Storage quota exceeded"}
+            )
+    return await call_next(request)
+
 # Fix CORS middleware setup
 app.add_middleware(
     CORSMiddleware,
@@ -98,6 +163,7 @@ ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 # Create tables if they don't exist (if you already have tables, this will be a no-op)
 Base.metadata.create_all(bind=engine)
@@ -208,6 +274,216 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         raise credentials_exception
     return user
 
+async def get_optional_current_user(
+    token: str | None = Depends(optional_oauth2_scheme),
+    db: Session = Depends(get_db)
+) -> models.User | None:
+    """The caller if a bearer token was sent, for endpoints that also accept other credentials"""
+    if token is None:
+        return None
+    return await get_current_user(token, db)
+
+MEMBERSHIP_INDEX_TTL = int(os.getenv("MEMBERSHIP_INDEX_TTL", "300"))
+
+class ClassMembershipIndex:
+    """Process-level cache of class rosters and teacher class lists.
+
+    Entries load lazily per key and are dropped by the endpoints that change
+    enrollments or classes. Other workers keep their own copy, so entries also
+    expire after `ttl` seconds and a negative `is_enrolled` answer is confirmed
+    against the database before access is denied. Every invalidation bumps a
+    generation, and a load that overlapped one is returned but not cached.
+    """
+
+    def __init__(self, ttl: int = MEMBERSHIP_INDEX_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._class_students = {}
+        self._student_classes = {}
+        self._teacher_classes = {}
+
+    def _lookup(self, table: dict, key: int, load) -> frozenset[int]:
+        now = time.monotonic()
+        with self._lock:
+            entry = table.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        members = frozenset(load())
+        with self._lock:
+            if self._generation == generation:
+                table[key] = (now, members)
+        return members
+
+    def class_students(self, db: Session, class_id: int) -> frozenset[int]:
+        return self._lookup(self._class_students, class_id, lambda: (
+            row.student_id
+            for row in db.query(models.ClassEnrollment.student_id)
+            .filter(models.ClassEnrollment.class_id == class_id)
+            .all()
+        ))
+
+    def student_classes(self, db: Session, student_id: int) -> frozenset[int]:
+        return self._lookup(self._student_classes, student_id, lambda: (
+            row.class_id
+            for row in db.query(models.ClassEnrollment.class_id)
+            .filter(models.ClassEnrollment.student_id == student_id)
+            .all()
+        ))
+
+    def teacher_classes(self, db: Session, teacher_id: int) -> frozenset[int]:
+        return self._lookup(self._teacher_classes, teacher_id, lambda: (
+            row.id
+            for row in db.query(models.Class.id)
+            .filter(models.Class.teacher_id == teacher_id)
+            .all()
+        ))
+
+    def is_enrolled(self, db: Session, student_id: int, class_id: int) -> bool:
+        if class_id in self.student_classes(db, student_id):
+            return True
+        enrolled = db.query(models.ClassEnrollment.id).filter(
+            models.ClassEnrollment.student_id == student_id,
+            models.ClassEnrollment.class_id == class_id
+        ).first() is not None
+        if enrolled:
+            self.enrollment_changed(student_id, class_id)
+        return enrolled
+
+    def enrollment_changed(self, student_id: int, class_id: int | None = None):
+        with self._lock:
+            self._generation += 1
+            self._student_classes.pop(student_id, None)
+            if class_id is not None:
+                self._class_students.pop(class_id, None)
+
+    def teacher_changed(self, teacher_id: int):
+        with self._lock:
+            self._generation += 1
+            self._teacher_classes.pop(teacher_id, None)
+
+    def class_removed(self, class_id: int, teacher_id: int | None = None):
+        with self._lock:
+            self._generation += 1
+            self._class_students.pop(class_id, None)
+            if teacher_id is not None:
+                self._teacher_classes.pop(teacher_id, None)
+            for student_id, (_, classes) in list(self._student_classes.items()):
+                if class_id in classes:
+                    del self._student_classes[student_id]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._class_students.clear()
+            self._student_classes.clear()
+            self._teacher_classes.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "classes": len(self._class_students),
+                "students": len(self._student_classes),
+                "teachers": len(self._teacher_classes),
+                "memberships": sum(len(m) for _, m in self._class_students.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0
+            }
+
+membership_index = ClassMembershipIndex()
+
+class AccessContext:
+    """Per-request memo of authorization lookups for the current user.
+
+    Each fact (teacher record, class row, class access, class ids of a user)
+    is loaded at most once per request; `loads` counts the actual lookups.
+    """
+
+    def __init__(self, db: Session, user: models.User):
+        self.db = db
+        self.user = user
+        self.loads = {}
+        self._teacher_loaded = False
+        self._teacher = None
+        self._classes = {}
+        self._class_access = {}
+        self._user_class_ids = {}
+
+    def _count(self, fact: str):
+        self.loads[fact] = self.loads.get(fact, 0) + 1
+
+    def teacher(self) -> models.Teacher | None:
+        if not self._teacher_loaded:
+            self._count("teacher")
+            self._teacher = _get_teacher_record(self.db, self.user)
+            self._teacher_loaded = True
+        return self._teacher
+
+    def get_class_or_404(self, class_id: int) -> models.Class:
+        if class_id not in self._classes:
+            self._count("class")
+            self._classes[class_id] = self.db.query(models.Class).filter(
+                models.Class.id == class_id
+            ).first()
+        db_class = self._classes[class_id]
+        if not db_class:
+            raise HTTPException(status_code=404, detail="Class not found")
+        return db_class
+
+    def ensure_class_access(self, class_id: int) -> models.Class:
+        if class_id not in self._class_access:
+            self._count("class_access")
+            try:
+                db_class = self.get_class_or_404(class_id)
+                if self.user.role == models.UserRole.ADMIN:
+                    self._class_access[class_id] = None
+                elif self.user.role == models.UserRole.TEACHER:
+                    teacher = self.teacher()
+                    if teacher and db_class.teacher_id == teacher.id:
+                        self._class_access[class_id] = None
+                    else:
+                        raise HTTPException(status_code=403, detail="Not authorized to access this class")
+                else:
+                    if not membership_index.is_enrolled(self.db, self.user.id, class_id):
+                        raise HTTPException(status_code=403, detail="Not enrolled in this class")
+                    self._class_access[class_id] = None
+            except HTTPException as e:
+                self._class_access[class_id] = e
+        denied = self._class_access[class_id]
+        if denied is not None:
+            raise denied
+        return self._classes[class_id]
+
+    def is_class_teacher(self, db_class: models.Class) -> bool:
+        teacher = self.teacher()
+        return bool(teacher and db_class.teacher_id == teacher.id)
+
+    def user_class_ids(self, user: models.User | None = None) -> List[int]:
+        user = user or self.user
+        if user.id not in self._user_class_ids:
+            self._count("user_class_ids")
+            if user.id == self.user.id and user.role == models.UserRole.TEACHER:
+                teacher = self.teacher()
+                self._user_class_ids[user.id] = sorted(
+                    membership_index.teacher_classes(self.db, teacher.id)
+                ) if teacher else []
+            else:
+                self._user_class_ids[user.id] = _get_user_class_ids(self.db, user)
+        return self._user_class_ids[user.id]
+
+def get_access_context(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+) -> AccessContext:
+    return AccessContext(db, current_user)
+
 @app.post("/api/auth/login")
 async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.email == login_data.email).first()
@@ -827,6 +1103,8 @@ def delete_blog(blog_id: int, db: Session = Depends(get_db)):
     blog = db.query(models.Blog).filter(models.Blog.id == blog_id).first()
     if not blog:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Blog not found")
+    _record_class_activity(db, blog.class_id, None, "posts", delta=-1, moment=blog.created_at)
+    _record_student_activity(db, blog.class_id, blog.owner_id, {"posts": -1}, active=False)
     db.delete(blog)
     db.commit()
     return {"message": "Blog deleted"}
@@ -870,23 +1148,33 @@ async def update_role(
     user.role = role_data["role"]
     user.is_admin = _is_admin_role(role_data["role"])
     
+    enrolled_class_id = None
     if role_data["role"] == models.UserRole.STUDENT and "classCode" in role_data:
         class_ = db.query(models.Class).filter(models.Class.access_code == role_data["classCode"]).first()
         if class_:
-            enrollment = models.ClassEnrollment(student_id=user.id, class_id=class_.id)
-            db.add(enrollment)
+            existing_enrollment = db.query(models.ClassEnrollment).filter(
+                models.ClassEnrollment.student_id == user.id,
+                models.ClassEnrollment.class_id == class_.id
+            ).first()
+            if not existing_enrollment:
+                enrollment = models.ClassEnrollment(student_id=user.id, class_id=class_.id)
+                db.add(enrollment)
+                _record_event(db, user.id, class_.id, "enrollment", class_.id)
+                enrolled_class_id = class_.id
     
     db.commit()
+    membership_index.enrollment_changed(user.id, enrolled_class_id)
     return {"message": "Role updated successfully"}
 
 @app.get("/api/classes/{class_id}/details")
 async def get_class_details(
     class_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     """Get detailed information about a class"""
-    db_class = _ensure_class_access(db, current_user, class_id)
+    db_class = access.ensure_class_access(class_id)
     
     # Get enrollment count
     enrollment_count = db.query(models.ClassEnrollment).filter(
@@ -978,15 +1266,11 @@ async def create_class_post(
 ):
     # Verify user has access to this class
     if current_user.role == models.UserRole.STUDENT:
-        enrollment = db.query(models.ClassEnrollment).filter(
-            models.ClassEnrollment.student_id == current_user.id,
-            models.ClassEnrollment.class_id == class_id
-        ).first()
-        if not enrollment:
+        if not membership_index.is_enrolled(db, current_user.id, class_id):
             raise HTTPException(status_code=403, detail="Not enrolled in this class")
     
     # Sanitize the content while preserving styles
-    content = sanitize_html(post.content)
+    content = _unsign_media_urls(sanitize_html(post.content))
     
     # Process rich content markers
     if post.code_snippets:
@@ -1021,13 +1305,17 @@ async def create_class_post(
     )
     
     db.add(new_post)
+    db.flush()
+    _record_event(db, current_user.id, class_id, "post", new_post.id)
+    _record_class_activity(db, class_id, current_user, "posts")
+    _record_student_activity(db, class_id, current_user.id, {"posts": 1})
     db.commit()
     db.refresh(new_post)
     
     return {
         "id": new_post.id,
         "title": new_post.title,
-        "content": new_post.content,
+        "content": _sign_media_urls(new_post.content, f"class:{class_id}"),
         "created_at": new_post.created_at,
         "owner_id": new_post.owner_id,
         "class_id": new_post.class_id,
@@ -1040,9 +1328,10 @@ async def create_class_post(
 async def get_class_posts(
     class_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
-    db_class = _ensure_class_access(db, current_user, class_id)
+    db_class = access.ensure_class_access(class_id)
     
     # Get posts with author information
     posts = db.query(models.Blog).filter(
@@ -1056,7 +1345,7 @@ async def get_class_posts(
         formatted_posts.append({
             "id": post.id,
             "title": post.title,
-            "content": post.content,  # Whitespace will be preserved
+            "content": _sign_media_urls(post.content, f"class:{class_id}"),  # Whitespace will be preserved
             "created_at": post.created_at,
             "author": f"{author.first_name} {author.last_name}" if author else "Unknown Author",
             "likes": len(post.likes) if hasattr(post, 'likes') else 0,
@@ -1134,68 +1423,980 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 (UPLOAD_DIR / "images").mkdir(exist_ok=True)
 (UPLOAD_DIR / "videos").mkdir(exist_ok=True)
 (UPLOAD_DIR / "files").mkdir(exist_ok=True)
+(UPLOAD_DIR / "blobs").mkdir(exist_ok=True)
+(UPLOAD_DIR / "temp").mkdir(exist_ok=True)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_BYTES = {
+    "image": int(os.getenv("UPLOAD_MAX_IMAGE_BYTES", str(10 * 1024 * 1024))),
+    "video": int(os.getenv("UPLOAD_MAX_VIDEO_BYTES", str(500 * 1024 * 1024))),
+    "file": int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(50 * 1024 * 1024))),
+}
+
+def _upload_kind(file: UploadFile) -> str:
+    """Size class of an upload going through the generic endpoint"""
+    content_type = file.content_type or ""
+    if content_type.startswith("image/"):
+        return "image"
+    if content_type.startswith("video/"):
+        return "video"
+    return "file"
+
+async def _stream_upload(file: UploadFile, kind: str, quota_remaining: int | None = None) -> tuple[Path, str, dict]:
+    """Stream an upload to a temp file without blocking the event loop.
+
+    Chunks are read from the UploadFile and written (and hashed) from a
+    worker thread one at a time, so memory use is one chunk and a slow disk
+    slows the reader down. Oversize requests are normally refused from their
+    Content-Length by reject_oversize_uploads before the body is read; the
+    limits for `kind` and `quota_remaining` are checked again here against
+    the bytes actually received, removing the partial file on a 413.
+    Returns the temp path, the SHA-256 and transfer stats.
+    """
+    max_bytes = UPLOAD_MAX_BYTES[kind]
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File is larger than the {max_bytes // (1024 * 1024)} MB limit for {kind} uploads"
+    )
+    if quota_remaining is not None and quota_remaining < max_bytes:
+        max_bytes = max(quota_remaining, 0)
+        too_large = _storage_quota_exceeded()
+    if file.size is not None and file.size > max_bytes:
+        raise too_large
+
+    temp_path = UPLOAD_DIR / "temp" / f"{secrets.token_hex(16)}.part"
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    size = 0
+    handle = await asyncio.to_thread(temp_path.open, "wb")
+
+    def write_chunk(chunk: bytes):
+        handle.write(chunk)
+        digest.update(chunk)
+
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise too_large
+            await asyncio.to_thread(write_chunk, chunk)
+        await asyncio.to_thread(handle.close)
+    except BaseException:
+        handle.close()
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    return temp_path, digest.hexdigest(), {
+        "size": size,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "throughput_bytes_per_sec": int(size / elapsed)
+    }
+
+USER_STORAGE_QUOTA = int(os.getenv("USER_STORAGE_QUOTA_BYTES", str(2 * 1024 ** 3)))  # 0 disables
+CLASS_STORAGE_QUOTA = int(os.getenv("CLASS_STORAGE_QUOTA_BYTES", str(50 * 1024 ** 3)))  # 0 disables
+
+# Multipart upload routes and the size class their file is limited to (None: any)
+UPLOAD_ROUTE_KINDS = {
+    "/api/upload/image": "image",
+    "/api/upload/video": "video",
+    "/api/upload/file": "file",
+    "/api/upload": None,
+    "/api/user/upload-profile-image": "image",
+    "/api/user/upload-cover-image": "image",
+}
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024  # boundaries and part headers around the file
+
+def _upload_request_quota(request: Request) -> int | None:
+    """Storage left for the sender of an upload request, from its bearer
+    token and class_id, before the body is read. None when unlimited or when
+    the token is missing or invalid (the endpoint then refuses it)."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        user_id = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
+    class_id = request.query_params.get("class_id", "")
+    db = SessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if user is None:
+            return None
+        return _storage_remaining(db, user, int(class_id) if class_id.isdigit() else None)
+    finally:
+        db.close()
+
+def _storage_quota_exceeded() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="Storage quota exceeded"
+    )
+
+STORAGE_USAGE_LOCK_KEY = 0x5354_4F52_4147_4555  # 'STORAGEU'; shared by updates, exclusive for a rebuild
+
+def _record_storage_usage(db: Session, user_id: int, class_id: int | None, size: int, files: int) -> dict[str, int]:
+    """Add to the user's (and class's) storage totals, returns the new byte counts by scope"""
+    db.execute(text("SELECT pg_advisory_xact_lock_shared(:key)"), {"key": STORAGE_USAGE_LOCK_KEY})
+    usage = {}
+    table = models.StorageUsage.__table__
+    for scope, scope_id in (("user", user_id), ("class", class_id)):
+        if scope_id is None:
+            continue
+        usage[scope] = db.execute(
+            pg_insert(table).values(
+                scope=scope,
+                scope_id=scope_id,
+                bytes=size,
+                files=files
+            ).on_conflict_do_update(
+                index_elements=["scope", "scope_id"],
+                set_={
+                    "bytes": table.c.bytes + size,
+                    "files": table.c.files + files,
+                    "updated_at": func.now()
+                }
+            ).returning(table.c.bytes)
+        ).scalar()
+    return usage
+
+def _is_over_quota(usage: dict[str, int]) -> bool:
+    return bool(
+        (USER_STORAGE_QUOTA and usage.get("user", 0) > USER_STORAGE_QUOTA)
+        or (CLASS_STORAGE_QUOTA and usage.get("class", 0) > CLASS_STORAGE_QUOTA)
+    )
+
+def _storage_remaining(db: Session, user: models.User, class_id: int | None = None) -> int | None:
+    """Bytes the user may still upload (into `class_id`), or None when unlimited"""
+    if user.is_admin:
+        return None
+    used = {
+        scope: used_bytes
+        for scope, used_bytes in db.query(models.StorageUsage.scope, models.StorageUsage.bytes).filter(
+            ((models.StorageUsage.scope == "user") & (models.StorageUsage.scope_id == user.id))
+            | ((models.StorageUsage.scope == "class") & (models.StorageUsage.scope_id == class_id))
+        ).all()
+    }
+    remaining = []
+    if USER_STORAGE_QUOTA:
+        remaining.append(USER_STORAGE_QUOTA - used.get("user", 0))
+    if class_id is not None and CLASS_STORAGE_QUOTA:
+        remaining.append(CLASS_STORAGE_QUOTA - used.get("class", 0))
+    return min(remaining) if remaining else None
+
+def _blob_path(sha256: str) -> Path:
+    return UPLOAD_DIR / "blobs" / sha256[:2] / sha256
+
+def _lock_blob(db: Session, sha256: str):
+    """Serialize blob row and file changes for one hash until the transaction ends"""
+    db.execute(
+        text("SELECT pg_advisory_xact_lock(:key)"),
+        {"key": int.from_bytes(bytes.fromhex(sha256[:16]), "big", signed=True)}
+    )
+
+def _add_blob_reference(
+    db: Session,
+    temp_path: Path,
+    sha256: str,
+    size: int,
+    content_type: str | None,
+    user_id: int,
+    path: str,
+    filename: str | None,
+    class_id: int | None = None,
+    enforce_quota: bool = False
+) -> models.UploadBlob:
+    """Point the logical `path` at the blob for `sha256`, storing the temp file
+    as that blob unless an identical one is already there. Charges the size
+    to the user's and class's storage usage, refusing it past the quota when
+    `enforce_quota` is set. Commits."""
+    blob_path = _blob_path(sha256)
+    placed = False
+    try:
+        _lock_blob(db, sha256)
+        blob_table = models.UploadBlob.__table__
+        blob_id = db.execute(
+            pg_insert(blob_table).values(
+                sha256=sha256,
+                size=size,
+                content_type=content_type,
+                ref_count=1
+            ).on_conflict_do_update(
+                index_elements=["sha256"],
+                set_={"ref_count": blob_table.c.ref_count + 1}
+            ).returning(blob_table.c.id)
+        ).scalar()
+        # Also restores a blob file that went missing
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp_path, blob_path)
+            placed = True
+        db.add(models.UploadReference(
+            user_id=user_id,
+            blob_id=blob_id,
+            path=path,
+            filename=filename,
+            class_id=class_id
+        ))
+        # Final check, since concurrent uploads all passed the pre-stream one
+        usage = _record_storage_usage(db, user_id, class_id, size, 1)
+        if enforce_quota and _is_over_quota(usage):
+            raise _storage_quota_exceeded()
+        db.commit()
+    except BaseException:
+        db.rollback()
+        if placed:
+            blob_path.unlink(missing_ok=True)
+        raise
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return db.query(models.UploadBlob).filter(models.UploadBlob.id == blob_id).first()
+
+async def _store_upload(
+    db: Session,
+    file: UploadFile,
+    kind: str,
+    user: models.User,
+    path: str,
+    class_id: int | None = None
+) -> dict:
+    """Stream an upload into the content-addressed store under the logical
+    `path` (relative to /uploads/), within the user's and class's storage
+    quotas. Identical content is stored only once."""
+    # Already checked against Content-Length by reject_oversize_uploads; this
+    # bounds the bytes actually received
+    quota_remaining = _storage_remaining(db, user, class_id)
+    # Release the connection while the body streams
+    db.commit()
+    temp_path, sha256, upload = await _stream_upload(file, kind, quota_remaining)
+    content_type = file.content_type or mimetypes.guess_type(path)[0]
+    blob = _add_blob_reference(
+        db, temp_path, sha256, upload["size"], content_type, user.id, path, file.filename,
+        class_id=class_id, enforce_quota=quota_remaining is not None
+    )
+    return {
+        "sha256": sha256,
+        "deduplicated": blob.ref_count > 1,
+        **upload
+    }
+
+def _release_upload(db: Session, reference: models.UploadReference):
+    """Drop a reference and its image variants, removing blobs once nothing
+    points at them. Commits."""
+    for variant_path in (reference.variants or {}).values():
+        variant = db.query(models.UploadReference).filter(
+            models.UploadReference.path == variant_path
+        ).first()
+        if variant:
+            _release_upload(db, variant)
+    blob = db.query(models.UploadBlob).filter(models.UploadBlob.id == reference.blob_id).first()
+    _lock_blob(db, blob.sha256)
+    _forget_upload_path(reference.path)
+    _record_storage_usage(db, reference.user_id, reference.class_id, -blob.size, -1)
+    db.delete(reference)
+    db.flush()
+    ref_count = db.execute(
+        models.UploadBlob.__table__.update().where(
+            models.UploadBlob.id == blob.id
+        ).values(
+            ref_count=models.UploadBlob.ref_count - 1
+        ).returning(models.UploadBlob.ref_count)
+    ).scalar()
+    if ref_count <= 0:
+        db.execute(models.UploadBlob.__table__.delete().where(models.UploadBlob.id == blob.id))
+        _blob_path(blob.sha256).unlink(missing_ok=True)
+    db.commit()
+
+UPLOAD_NAME_UNSAFE = re.compile(r"[^A-Za-z0-9._-]+")
+
+def _unique_upload_name(filename: str) -> str:
+    """Stored name for an upload; characters that need escaping in a URL
+    become '_' (the original name is kept on the reference)"""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+    name = UPLOAD_NAME_UNSAFE.sub("_", Path(filename or "").name).strip("._") or "file"
+    return f"{timestamp}_{random_str}_{name}"
+
+FILE_DELIVERY_MODE = os.getenv("FILE_DELIVERY_MODE", "python")  # 'python' or 'nginx'
+X_ACCEL_UPLOADS_PREFIX = os.getenv("X_ACCEL_UPLOADS_PREFIX", "/internal-uploads/")  # internal nginx location aliasing uploads/
+UPLOAD_PATH_CACHE_TTL = int(os.getenv("UPLOAD_PATH_CACHE_TTL", "60"))
+UPLOAD_PATH_CACHE_SIZE = 10000
+
+_upload_path_cache = {}
+_upload_path_cache_lock = threading.Lock()
+
+def _lookup_upload_reference(db: Session, file_path: str) -> tuple | None:
+    """(sha256, content_type, variants, user_id, variant_state) of the upload at a logical path.
+
+    Cached per process for UPLOAD_PATH_CACHE_TTL seconds, since every page
+    view resolves the same paths again; a path keeps its blob for as long
+    as it exists.
+    """
+    now = time.monotonic()
+    with _upload_path_cache_lock:
+        entry = _upload_path_cache.get(file_path)
+    if entry and now - entry[0] < UPLOAD_PATH_CACHE_TTL:
+        return entry[1]
+
+    row = db.query(
+        models.UploadBlob.sha256,
+        models.UploadBlob.content_type,
+        models.UploadReference.variants,
+        models.UploadReference.user_id,
+        models.UploadReference.variant_state
+    ).join(
+        models.UploadReference, models.UploadReference.blob_id == models.UploadBlob.id
+    ).filter(models.UploadReference.path == file_path).first()
+    value = tuple(row) if row else None
+    with _upload_path_cache_lock:
+        _upload_path_cache.pop(file_path, None)
+        if len(_upload_path_cache) >= UPLOAD_PATH_CACHE_SIZE:
+            _upload_path_cache.pop(next(iter(_upload_path_cache)))
+        _upload_path_cache[file_path] = (now, value)
+    return value
+
+def _forget_upload_path(file_path: str):
+    with _upload_path_cache_lock:
+        _upload_path_cache.pop(file_path, None)
+
+def _resolve_upload(db: Session, file_path: str, variant: str | None = None) -> tuple[Path, str | None, str | None] | None:
+    """Disk location, content type and SHA-256 behind a path under /uploads/.
+
+    Paths of stored uploads map to their blob, or to the blob of the named
+    image `variant` once it has been generated; anything else is looked up
+    as a plain file under the uploads directory (uploads from before the
+    store existed), which has no known type or hash.
+    """
+    reference = _lookup_upload_reference(db, file_path)
+    if reference:
+        sha256, content_type, variants = reference[:3]
+        if variant and variants and variant in variants:
+            resolved = _resolve_upload(db, variants[variant])
+            if resolved:
+                return resolved
+        return _blob_path(sha256), content_type, sha256
+
+    if _clean_upload_path(file_path) is None:
+        return None
+    root = UPLOAD_DIR.resolve()
+    full_path = (root / file_path).resolve()
+    if not full_path.is_relative_to(root) or not full_path.is_file():
+        return None
+    # Store internals are only reachable through a reference
+    if f"{full_path.relative_to(root).as_posix()}/".startswith(UPLOAD_INTERNAL_PREFIXES):
+        return None
+    return full_path, None, None
+
+UPLOAD_INTERNAL_PREFIXES = ("blobs/", "temp/", "sessions/")
+
+def _clean_upload_path(file_path: str) -> str | None:
+    """`file_path` if it is a plain relative path under /uploads/, else None.
+
+    Owner checks read the first segment, so '..', '.' and empty segments
+    (which could point the path at another directory once resolved) are
+    refused rather than normalized.
+    """
+    if not file_path or "\\" in file_path or "\x00" in file_path:
+        return None
+    if any(segment in ("", ".", "..") for segment in file_path.split("/")):
+        return None
+    return file_path
+
+def _require_clean_upload_path(file_path: str) -> str:
+    if _clean_upload_path(file_path) is None:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    return file_path
+
+def _get_upload_owner_id(db: Session, file_path: str) -> int | None:
+    """Uploader of a logical path; older uploads are only known by their
+    per-user directory"""
+    reference = _lookup_upload_reference(db, file_path)
+    if reference:
+        return reference[3]
+    if _clean_upload_path(file_path) is None:
+        return None
+    owner_dir = file_path.split("/", 1)[0]
+    return int(owner_dir) if owner_dir.isdigit() else None
+
+def _ensure_upload_access(db: Session, access: AccessContext, file_path: str):
+    """Uploads are readable by their owner, admins and anyone sharing a class
+    with the owner. Paths with no known owner are refused."""
+    owner_id = _get_upload_owner_id(db, file_path)
+    if owner_id is None:
+        raise HTTPException(status_code=403, detail="Not authorized to access this file")
+    if owner_id == access.user.id or access.user.is_admin:
+        return
+    owner = db.query(models.User).filter(models.User.id == owner_id).first()
+    if owner and set(access.user_class_ids()) & set(access.user_class_ids(owner)):
+        return
+    raise HTTPException(status_code=403, detail="Not authorized to access this file")
+
+MEDIA_URL_SECRET = os.getenv("MEDIA_URL_SECRET") or SECRET_KEY
+if not MEDIA_URL_SECRET:
+    raise RuntimeError("Set MEDIA_URL_SECRET or SECRET_KEY to sign media URLs")
+MEDIA_URL_TTL = int(os.getenv("MEDIA_URL_TTL", str(7 * 24 * 3600)))
+MEDIA_URL_BUCKET = 24 * 3600  # expiries are rounded up to this, so re-rendered URLs stay cacheable
+MEDIA_PUBLIC_PREFIXES = ("profile_images/", "cover_images/")  # avatars and banners, shown to anyone
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# A quoted attribute value may hold an unescaped space (uploads stored before
+# names were sanitized); elsewhere a URL ends at whitespace
+MEDIA_URL_PATTERN = re.compile(
+    r"(?<=[\"'])/uploads/(?P<quoted_path>[^\"'?#<>]+)(?P<quoted_query>\?[^\"'#<>]*)?(?=[\"'])"
+    r"|/uploads/(?P<path>[^\"'\s?#<>()\[\]|]+)(?P<query>\?[^\"'\s#<>()\[\]|]*)?"
+)
+MEDIA_SIGNATURE_PARAMS = {"exp", "scope", "sig"}
+
+def _media_signature(path: str, exp: int, scope: str, params: list[str]) -> str:
+    """HMAC over the path, expiry, scope and the other query parameters
+    (size, original), so a signed URL cannot be turned into another one"""
+    payload = "\n".join([path, str(exp), scope, *sorted(params)])
+    digest = hmac.new(MEDIA_URL_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).rstrip(b"=").decode()
+
+def _verify_media_signature(path: str, request: Request) -> bool:
+    """Check a signed media URL from its query parameters alone, without the database"""
+    query = request.query_params
+    exp, scope, sig = query.get("exp"), query.get("scope"), query.get("sig")
+    if not exp or not exp.isdigit() or not scope or not sig or int(exp) < time.time():
+        return False
+    params = [f"{key}={value}" for key, value in query.multi_items() if key not in MEDIA_SIGNATURE_PARAMS]
+    return hmac.compare_digest(sig, _media_signature(path, int(exp), scope, params))
+
+def _media_url_expiry() -> int:
+    return -(-(int(time.time()) + MEDIA_URL_TTL) // MEDIA_URL_BUCKET) * MEDIA_URL_BUCKET
+
+def _signed_media_url(path: str, scope: str, params: list[str] | None = None, exp: int | None = None,
+                      separator: str = "&") -> str:
+    """/uploads/ URL for the logical (unescaped) `path`, signed for `scope`
+    ('class:<id>' or 'user:<id>'). The signature covers the path as
+    serve_upload receives it, decoded; the URL carries it percent-encoded."""
+    params = list(params or [])
+    exp = exp or _media_url_expiry()
+    params += [f"exp={exp}", f"scope={scope}", f"sig={_media_signature(path, exp, scope, params)}"]
+    return f"/uploads/{quote(path)}?" + separator.join(params)
+
+def _media_url_parts(match: re.Match) -> tuple[str, str | None]:
+    """Path (as written) and query string of a MEDIA_URL_PATTERN match"""
+    if match.group("quoted_path") is not None:
+        return match.group("quoted_path"), match.group("quoted_query")
+    return match.group("path"), match.group("query")
+
+def _split_media_query(query: str | None) -> list[str]:
+    if not query:
+        return []
+    return [
+        param for param in query[1:].replace("&amp;", "&").split("&")
+        if param and param.split("=", 1)[0] not in MEDIA_SIGNATURE_PARAMS
+    ]
+
+def _sign_media_urls(content: str | None, scope: str) -> str | None:
+    """Rewrite /uploads/ URLs in rendered post content into signed URLs for
+    `scope` ('class:<id>' or 'user:<id>') that expire after MEDIA_URL_TTL"""
+    if not content or "/uploads/" not in content:
+        return content
+    exp = _media_url_expiry()
+
+    def sign(match):
+        # Escaped inside HTML attributes, literal in the [FILE:...] style markers
+        in_tag = content.rfind("<", 0, match.start()) > content.rfind(">", 0, match.start())
+        path, query = _media_url_parts(match)
+        return _signed_media_url(
+            unquote(path), scope, _split_media_query(query), exp, "&amp;" if in_tag else "&"
+        )
+
+    return MEDIA_URL_PATTERN.sub(sign, content)
+
+def _unsign_media_urls(content: str | None) -> str | None:
+    """Strip signatures from media URLs before post content is stored"""
+    if not content or "sig=" not in content:
+        return content
+
+    def unsign(match):
+        path, query = _media_url_parts(match)
+        params = _split_media_query(query)
+        in_tag = content.rfind("<", 0, match.start()) > content.rfind(">", 0, match.start())
+        return f"/uploads/{path}" + ("?" + ("&amp;" if in_tag else "&").join(params) if params else "")
+
+    return MEDIA_URL_PATTERN.sub(unsign, content)
+
+def _is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _upload_file_response(
+    request: Request,
+    resolved: tuple[Path, str | None, str | None],
+    filename: str | None = None,
+    content_disposition_type: str = "inline",
+    cache_control: str | None = None
+) -> Response:
+    """Response for a resolved upload that answers conditional requests.
+
+    With FILE_DELIVERY_MODE=python, FileResponse streams the body and serves
+    byte ranges (206) itself; blob-backed files use their SHA-256 as a
+    strong ETag. With FILE_DELIVERY_MODE=nginx the body is left to nginx
+    through X-Accel-Redirect, and nginx replaces the upstream ETag and
+    Last-Modified with its own, built from the file's mtime and size. The
+    validators used here then follow nginx's format, so a 304 answered by
+    the API and one answered by nginx carry the same values.
+    """
+    full_path, content_type, sha256 = resolved
+    try:
+        stat_result = os.stat(full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if FILE_DELIVERY_MODE == "nginx":
+        etag = f'"{int(stat_result.st_mtime):x}-{stat_result.st_size:x}"'
+    elif sha256:
+        etag = f'"{sha256}"'
+    else:
+        etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "accept-ranges": "bytes"
+    }
+    if cache_control:
+        headers["cache-control"] = cache_control
+    if _is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    media_type = content_type or mimetypes.guess_type(filename or full_path.name)[0] or "application/octet-stream"
+    if FILE_DELIVERY_MODE == "nginx":
+        relative_path = full_path.resolve().relative_to(UPLOAD_DIR.resolve()).as_posix()
+        headers["x-accel-redirect"] = f"{X_ACCEL_UPLOADS_PREFIX}{quote(relative_path)}"
+        if filename:
+            headers["content-disposition"] = f"{content_disposition_type}; filename*=utf-8''{quote(filename)}"
+        return Response(media_type=media_type, headers=headers)
+    return FileResponse(
+        path=full_path,
+        media_type=media_type,
+        filename=filename,
+        content_disposition_type=content_disposition_type,
+        stat_result=stat_result,
+        headers=headers
+    )
+
+IMAGE_VARIANT_SIZES = {"thumb": 200, "feed": 800, "full": 1600}  # longest side in pixels
+IMAGE_VARIANT_FORMAT = os.getenv("IMAGE_VARIANT_FORMAT", "webp")  # 'webp' or 'jpeg'
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+IMAGE_VARIANT_SOURCE_TYPES = {"image/jpeg", "image/png", "image/webp"}
+
+_image_variant_pool = None
+_image_variant_tasks = set()
+
+def _render_image_variants(source: str, output_dir: str, fmt: str, quality: int) -> dict[str, str]:
+    """Write resized copies of an image for each of IMAGE_VARIANT_SIZES.
+
+    Runs in a worker process. The EXIF orientation is applied to the pixels
+    and no metadata is written to the variants.
+    """
+    variants = {}
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha and fmt == "webp" else "RGB")
+        for name, longest_side in IMAGE_VARIANT_SIZES.items():
+            variant = image.copy()
+            variant.thumbnail((longest_side, longest_side), Image.LANCZOS)
+            output = Path(output_dir) / f"{name}.{fmt}"
+            variant.save(output, format=fmt.upper(), quality=quality, optimize=True)
+            variants[name] = str(output)
+    return variants
+
+def _store_image_variants(path: str, user_id: int, rendered: dict[str, str]):
+    """Add the rendered variants to the store and record them on the upload"""
+    db = SessionLocal()
+    try:
+        variants = {}
+        for name, output in rendered.items():
+            output = Path(output)
+            digest = hashlib.sha256(output.read_bytes()).hexdigest()
+            variant_path = f"{path}.{name}.{IMAGE_VARIANT_FORMAT}"
+            _add_blob_reference(
+                db, output, digest, output.stat().st_size, f"image/{IMAGE_VARIANT_FORMAT}",
+                user_id, variant_path, None
+            )
+            variants[name] = variant_path
+
+        reference = db.query(models.UploadReference).filter(
+            models.UploadReference.path == path
+        ).with_for_update().first()
+        if reference:
+            reference.variants = variants
+            reference.variant_state = "ready"
+            db.commit()
+            _forget_upload_path(path)
+        else:
+            # Deleted while rendering
+            db.rollback()
+            for variant in db.query(models.UploadReference).filter(
+                models.UploadReference.path.in_(list(variants.values()))
+            ).all():
+                _release_upload(db, variant)
+    finally:
+        db.close()
+
+def _set_variant_state(db: Session, path: str, state: str):
+    db.query(models.UploadReference).filter(
+        models.UploadReference.path == path
+    ).update({models.UploadReference.variant_state: state}, synchronize_session=False)
+    db.commit()
+    _forget_upload_path(path)
+
+def _mark_image_variants_failed(path: str):
+    db = SessionLocal()
+    try:
+        _set_variant_state(db, path, "failed")
+    finally:
+        db.close()
+
+async def _generate_image_variants(path: str, user_id: int, sha256: str):
+    global _image_variant_pool
+    if _image_variant_pool is None:
+        _image_variant_pool = ProcessPoolExecutor(max_workers=IMAGE_VARIANT_WORKERS)
+    output_dir = UPLOAD_DIR / "temp" / secrets.token_hex(16)
+    output_dir.mkdir()
+    try:
+        rendered = await asyncio.get_running_loop().run_in_executor(
+            _image_variant_pool, _render_image_variants,
+            str(_blob_path(sha256)), str(output_dir), IMAGE_VARIANT_FORMAT, IMAGE_VARIANT_QUALITY
+        )
+        await asyncio.to_thread(_store_image_variants, path, user_id, rendered)
+    except Exception as e:
+        print(f"Image variant generation failed for {path}: {str(e)}")
+        await asyncio.to_thread(_mark_image_variants_failed, path)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, output_dir, True)
+
+def _schedule_image_variants(
+    db: Session, file: UploadFile, path: str, user_id: int, sha256: str, scope: str | None = None
+) -> dict | None:
+    """Start rendering variants of an uploaded image in the background.
+
+    Returns the URL of each variant, signed for `scope` when given. Until
+    they are ready (or if the image cannot be resized here) those URLs
+    serve the original.
+    """
+    if Image is None or file.content_type not in IMAGE_VARIANT_SOURCE_TYPES:
+        return None
+    _set_variant_state(db, path, "pending")
+    task = asyncio.create_task(_generate_image_variants(path, user_id, sha256))
+    _image_variant_tasks.add(task)
+    task.add_done_callback(_image_variant_tasks.discard)
+    if scope:
+        return {name: _signed_media_url(path, scope, [f"size={name}"]) for name in IMAGE_VARIANT_SIZES}
+    return {name: f"/uploads/{quote(path)}?size={name}" for name in IMAGE_VARIANT_SIZES}
+
+def _upload_scope(user: models.User, class_id: int | None) -> str:
+    """Signing scope for a URL returned straight after an upload"""
+    return f"class:{class_id}" if class_id is not None else f"user:{user.id}"
 
 # Add these new endpoints
 @app.post("/api/upload/image")
-async def upload_image(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user)):
+async def upload_image(
+    file: UploadFile = File(...),
+    class_id: int | None = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
     try:
-        file_path = UPLOAD_DIR / "images" / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        return {"url": f"/uploads/images/{file.filename}"}
+        if class_id is not None:
+            access.ensure_class_access(class_id)
+        path = f"images/{_unique_upload_name(file.filename)}"
+        upload = await _store_upload(db, file, "image", current_user, path, class_id)
+        scope = _upload_scope(current_user, class_id)
+        variants = _schedule_image_variants(db, file, path, current_user.id, upload["sha256"], scope)
+        return {"url": _signed_media_url(path, scope), "variants": variants, **upload}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/upload/video")
-async def upload_video(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user)):
+async def upload_video(
+    file: UploadFile = File(...),
+    class_id: int | None = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
     try:
-        file_path = UPLOAD_DIR / "videos" / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        return {"url": f"/uploads/videos/{file.filename}"}
+        if class_id is not None:
+            access.ensure_class_access(class_id)
+        path = f"videos/{_unique_upload_name(file.filename)}"
+        upload = await _store_upload(db, file, "video", current_user, path, class_id)
+        return {"url": _signed_media_url(path, _upload_scope(current_user, class_id)), **upload}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/upload/file")
-async def upload_file(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user)):
+async def upload_file(
+    file: UploadFile = File(...),
+    class_id: int | None = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
     try:
-        file_path = UPLOAD_DIR / "files" / file.filename
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        return {"url": f"/uploads/files/{file.filename}"}
+        if class_id is not None:
+            access.ensure_class_access(class_id)
+        path = f"files/{_unique_upload_name(file.filename)}"
+        upload = await _store_upload(db, file, "file", current_user, path, class_id)
+        return {"url": _signed_media_url(path, _upload_scope(current_user, class_id)), **upload}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_CHUNK_CLAIM_TTL = int(os.getenv("UPLOAD_CHUNK_CLAIM_TTL", "600"))  # a chunk stalled this long can be retried
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    content_type: str | None = None
+
+def _upload_session_path(session_id: str) -> Path:
+    return UPLOAD_DIR / "temp" / f"{session_id}.part"
+
+def _upload_session_response(session: models.UploadSession) -> dict:
+    return {
+        "session_id": session.id,
+        "offset": session.received,
+        "size": session.size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_at": session.expires_at
+    }
+
+def _get_upload_session(db: Session, session_id: str, user_id: int, lock: bool = False) -> models.UploadSession:
+    query = db.query(models.UploadSession).filter(
+        models.UploadSession.id == session_id,
+        models.UploadSession.user_id == user_id,
+        models.UploadSession.expires_at > datetime.now(timezone.utc)
+    )
+    if lock:
+        # A concurrent finalize or cancel is refused instead of queued
+        try:
+            session = query.with_for_update(nowait=True).first()
+        except OperationalError:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Another chunk for this upload is in progress")
+    else:
+        session = query.first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    return session
+
+@app.post("/api/upload/video/sessions")
+async def create_video_upload_session(
+    upload: UploadSessionCreate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Start a resumable video upload; send the bytes with PATCH, then finalize"""
+    max_bytes = UPLOAD_MAX_BYTES["video"]
+    if upload.size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    if upload.size > max_bytes:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File is larger than the {max_bytes // (1024 * 1024)} MB limit for video uploads"
+        )
+    quota_remaining = _storage_remaining(db, current_user)
+    if quota_remaining is not None and upload.size > quota_remaining:
+        raise _storage_quota_exceeded()
+
+    session = models.UploadSession(
+        id=secrets.token_hex(16),
+        user_id=current_user.id,
+        filename=Path(upload.filename).name,
+        content_type=upload.content_type or mimetypes.guess_type(upload.filename)[0],
+        size=upload.size,
+        received=0,
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_SESSION_TTL)
+    )
+    await asyncio.to_thread(_upload_session_path(session.id).touch)
+    db.add(session)
+    db.commit()
+    return _upload_session_response(session)
+
+@app.get("/api/upload/video/sessions/{session_id}")
+async def get_video_upload_session(
+    session_id: str,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Where to resume: `offset` is the number of bytes received so far"""
+    return _upload_session_response(_get_upload_session(db, session_id, current_user.id))
+
+@app.patch("/api/upload/video/sessions/{session_id}")
+async def upload_video_chunk(
+    session_id: str,
+    offset: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Append the raw request body at `offset`, which must equal the received count.
+
+    Bytes are written straight into the session's part file. Whatever
+    arrived before a dropped connection is kept, so the client resumes from
+    the offset reported here or by GET.
+
+    The session is claimed in one short transaction and `received` is
+    written in another, so no connection or row lock is held while a slow
+    client sends the body. A second PATCH on a claimed session gets a 409.
+    """
+    table = models.UploadSession.__table__
+    now = datetime.now(timezone.utc)
+    claimed_until = now + timedelta(seconds=UPLOAD_CHUNK_CLAIM_TTL)
+    size = db.execute(
+        table.update().where(
+            table.c.id == session_id,
+            table.c.user_id == current_user.id,
+            table.c.expires_at > now,
+            table.c.received == offset,
+            (table.c.claimed_until.is_(None)) | (table.c.claimed_until < now)
+        ).values(
+            claimed_until=claimed_until,
+            expires_at=func.greatest(table.c.expires_at, claimed_until)
+        ).returning(table.c.size)
+    ).scalar()
+    db.commit()
+    if size is None:
+        session = _get_upload_session(db, session_id, current_user.id)
+        if offset != session.received:
+            raise HTTPException(status_code=409, detail=f"Expected offset {session.received}")
+        raise HTTPException(status_code=409, detail="Another chunk for this upload is in progress")
+
+    written = 0
+    try:
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and offset + int(content_length) > size:
+            raise HTTPException(status_code=400, detail="Chunk goes past the declared size")
+        handle = await asyncio.to_thread(_upload_session_path(session_id).open, "r+b")
+        try:
+            await asyncio.to_thread(handle.seek, offset)
+            async for chunk in request.stream():
+                if offset + written + len(chunk) > size:
+                    raise HTTPException(status_code=400, detail="Chunk goes past the declared size")
+                await asyncio.to_thread(handle.write, chunk)
+                written += len(chunk)
+        finally:
+            await asyncio.to_thread(handle.close)
+    finally:
+        # Only the holder of this claim may record its bytes; a claim that
+        # lapsed and was taken over leaves `received` to the new writer
+        db.execute(
+            table.update().where(
+                table.c.id == session_id,
+                table.c.claimed_until == claimed_until
+            ).values(
+                received=offset + written,
+                claimed_until=None,
+                expires_at=datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_SESSION_TTL)
+            )
+        )
+        db.commit()
+
+    return _upload_session_response(_get_upload_session(db, session_id, current_user.id))
+
+@app.post("/api/upload/video/sessions/{session_id}/finalize")
+async def finalize_video_upload(
+    session_id: str,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Turn a complete session into a stored video; the part file is moved, not copied"""
+    session = _get_upload_session(db, session_id, current_user.id, lock=True)
+    if session.received != session.size:
+        raise HTTPException(status_code=409, detail=f"Upload incomplete: {session.received} of {session.size} bytes")
+
+    part_path = _upload_session_path(session.id)
+
+    def hash_part() -> str:
+        digest = hashlib.sha256()
+        with part_path.open("rb") as part:
+            while chunk := part.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    sha256 = await asyncio.to_thread(hash_part)
+    path = f"videos/{_unique_upload_name(session.filename)}"
+    filename = session.filename
+    size, content_type = session.size, session.content_type
+    db.delete(session)
+    try:
+        blob = _add_blob_reference(
+            db, part_path, sha256, size, content_type, current_user.id, path, filename,
+            enforce_quota=not current_user.is_admin
+        )
+    except BaseException:
+        # The part file is gone with the failed store, so the session cannot resume
+        db.query(models.UploadSession).filter(models.UploadSession.id == session_id).delete()
+        db.commit()
+        raise
+    return {
+        "url": _signed_media_url(path, _upload_scope(current_user, None)),
+        "filename": filename,
+        "size": blob.size,
+        "sha256": sha256,
+        "deduplicated": blob.ref_count > 1
+    }
+
+@app.delete("/api/upload/video/sessions/{session_id}")
+async def cancel_video_upload(
+    session_id: str,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    session = _get_upload_session(db, session_id, current_user.id, lock=True)
+    db.delete(session)
+    db.commit()
+    await asyncio.to_thread(_upload_session_path(session_id).unlink, True)
+    return {"message": "Upload cancelled"}
+
 @app.post("/api/upload")
 async def upload_file(
     file: UploadFile = File(...),
-    current_user: models.User = Depends(get_current_user)
+    class_id: int | None = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
-    """Upload a file and return its URL"""
+    """Upload a file and return its URL; pass class_id to count it toward that class's storage"""
     try:
-        # Create uploads directory if it doesn't exist
-        upload_dir = Path("uploads")
-        user_dir = upload_dir / str(current_user.id)
-        user_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Generate a unique filename
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-        filename = f"{timestamp}_{random_str}_{file.filename}"
+        if class_id is not None:
+            access.ensure_class_access(class_id)
+        # Stored once per distinct content, under a per-user logical path
+        path = f"{current_user.id}/{_unique_upload_name(file.filename)}"
+        upload = await _store_upload(db, file, _upload_kind(file), current_user, path, class_id)
         
-        # Save the file
-        file_path = user_dir / filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Return the file URL
-        file_url = f"/uploads/{current_user.id}/{filename}"
+        # Return the file URL, signed so it previews before it is in a post
+        file_url = _signed_media_url(path, _upload_scope(current_user, class_id))
         
         return {
             "url": file_url,
             "filename": file.filename,
-            "size": os.path.getsize(file_path)
+            **upload
         }
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"File upload error: {str(e)}")
         raise HTTPException(
@@ -1205,59 +2406,48 @@ async def upload_file(
 
 @app.get("/api/teacher/dashboard")
 async def get_teacher_dashboard(
+    recent_limit: int = 5,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     """Get teacher dashboard data"""
     if current_user.role != models.UserRole.TEACHER:
         raise HTTPException(status_code=403, detail="Not a teacher")
     
     try:
-        # Get classes taught by this teacher
-        teacher = _get_teacher_record(db, current_user)
+        # Get classes taught by this teacher along with their counts
+        teacher = access.teacher()
         if not teacher:
-            classes = []
+            class_rows = []
         else:
-            classes = db.query(models.Class).filter(
+            enrollment_count = db.query(func.count(models.ClassEnrollment.id)).filter(
+                models.ClassEnrollment.class_id == models.Class.id
+            ).correlate(models.Class).scalar_subquery()
+            post_count = db.query(func.count(models.Blog.id)).filter(
+                models.Blog.class_id == models.Class.id
+            ).correlate(models.Class).scalar_subquery()
+            class_rows = db.query(models.Class, enrollment_count, post_count).filter(
                 models.Class.teacher_id == teacher.id
             ).all()
         
+        # Recent activity for every class in one windowed query
+        recent_by_class = _get_recent_posts_by_class(
+            db,
+            [class_.id for class_, _, _ in class_rows],
+            max(1, min(recent_limit, 20))
+        )
+        
         classes_data = []
-        for class_ in classes:
-            # Count enrollments for this class
-            enrollment_count = db.query(models.ClassEnrollment).filter(
-                models.ClassEnrollment.class_id == class_.id
-            ).count()
-            
-            # Count posts in this class
-            post_count = db.query(models.Blog).filter(
-                models.Blog.class_id == class_.id
-            ).count()
-            
-            # Get recent activity for this class
-            recent_posts = db.query(models.Blog).filter(
-                models.Blog.class_id == class_.id
-            ).order_by(models.Blog.created_at.desc()).limit(5).all()
-            
-            recent_activity = []
-            for post in recent_posts:
-                student = db.query(models.User).filter(models.User.id == post.owner_id).first()
-                if student:
-                    recent_activity.append({
-                        "id": post.id,
-                        "title": post.title,
-                        "student_name": f"{student.first_name} {student.last_name}",
-                        "created_at": post.created_at
-                    })
-            
+        for class_, enrollment_total, post_total in class_rows:
             classes_data.append({
                 "id": class_.id,
                 "name": class_.name,
                 "description": class_.description,
                 "access_code": class_.access_code,
-                "enrollment_count": enrollment_count,
-                "post_count": post_count,
-                "recent_activity": recent_activity
+                "enrollment_count": enrollment_total,
+                "post_count": post_total,
+                "recent_activity": recent_by_class.get(class_.id, [])
             })
         
         return {
@@ -1275,6 +2465,46 @@ async def get_teacher_dashboard(
             detail=f"Failed to load dashboard: {str(e)}"
         )
 
+def _get_recent_posts_by_class(db: Session, class_ids: List[int], limit: int) -> dict[int, list[dict]]:
+    """Top `limit` newest posts per class with author names, via ROW_NUMBER() OVER (PARTITION BY class_id)"""
+    if not class_ids:
+        return {}
+    
+    ranked = db.query(
+        models.Blog.id,
+        models.Blog.title,
+        models.Blog.class_id,
+        models.Blog.created_at,
+        models.Blog.owner_id,
+        func.row_number().over(
+            partition_by=models.Blog.class_id,
+            order_by=(models.Blog.created_at.desc(), models.Blog.id.desc())
+        ).label("position")
+    ).filter(models.Blog.class_id.in_(class_ids)).subquery()
+    
+    rows = db.query(
+        ranked.c.id,
+        ranked.c.title,
+        ranked.c.class_id,
+        ranked.c.created_at,
+        models.User.first_name,
+        models.User.last_name
+    ).join(
+        models.User, models.User.id == ranked.c.owner_id
+    ).filter(
+        ranked.c.position <= limit
+    ).order_by(ranked.c.class_id, ranked.c.position).all()
+    
+    recent = {}
+    for post_id, title, class_id, created_at, first_name, last_name in rows:
+        recent.setdefault(class_id, []).append({
+            "id": post_id,
+            "title": title,
+            "student_name": f"{first_name} {last_name}",
+            "created_at": created_at
+        })
+    return recent
+
 @app.post("/api/classes")
 async def create_class(
     class_data: dict,
@@ -1319,6 +2549,7 @@ async def create_class(
         db.add(new_class)
         db.commit()
         db.refresh(new_class)
+        membership_index.teacher_changed(teacher.id)
         
         return {
             "id": new_class.id,
@@ -1342,15 +2573,15 @@ async def create_assignment(
     class_id: int,
     assignment: schemas.AssignmentCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     if current_user.role not in [models.UserRole.TEACHER, models.UserRole.ADMIN]:
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    db_class = _get_class_or_404(db, class_id)
+    db_class = access.get_class_or_404(class_id)
     if current_user.role == models.UserRole.TEACHER:
-        teacher = _get_teacher_record(db, current_user)
-        if not teacher or db_class.teacher_id != teacher.id:
+        if not access.is_class_teacher(db_class):
             raise HTTPException(status_code=403, detail="Not authorized")
 
     visibility = assignment.visibility or "class"
@@ -1382,28 +2613,52 @@ async def create_assignment(
         "visibility": new_assignment.visibility
     }
 
+ASSIGNMENTS_PAGE_LIMIT = int(os.getenv("ASSIGNMENTS_PAGE_LIMIT", "500"))
+
 @app.get("/api/classes/{class_id}/assignments")
 async def list_assignments(
     class_id: int,
+    due: str | None = None,
+    skip: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1, le=ASSIGNMENTS_PAGE_LIMIT),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
-    db_class = _ensure_class_access(db, current_user, class_id)
-    assignments = db.query(models.Assignment).filter(
+    db_class = access.ensure_class_access(class_id)
+    query = db.query(models.Assignment).filter(
         models.Assignment.class_id == class_id
-    ).order_by(models.Assignment.due_date.asc()).all()
+    )
+    # Optional window: 'upcoming' (due now or later) or 'past'
+    if due == "upcoming":
+        query = query.filter(models.Assignment.due_date >= func.now())
+    elif due == "past":
+        query = query.filter(models.Assignment.due_date < func.now())
+    elif due is not None:
+        raise HTTPException(status_code=400, detail="due must be 'upcoming' or 'past'")
+    query = query.order_by(models.Assignment.due_date.asc(), models.Assignment.id.asc()).offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    assignments = query.all()
 
     total_students = _get_class_student_count(db, class_id)
+    stats_by_assignment = _get_assignment_stats_batch(db, assignments, {class_id: total_students})
+
+    # The caller's own submissions for every listed assignment in one query
+    my_submissions = {}
+    if current_user.role == models.UserRole.STUDENT and assignments:
+        my_submissions = {
+            submission.assignment_id: submission
+            for submission in db.query(models.AssignmentSubmission).filter(
+                models.AssignmentSubmission.assignment_id.in_([assignment.id for assignment in assignments]),
+                models.AssignmentSubmission.student_id == current_user.id
+            ).all()
+        }
     response = []
 
     for assignment in assignments:
-        stats = _get_assignment_stats(db, assignment, total_students)
-        submission = None
-        if current_user.role == models.UserRole.STUDENT:
-            submission = db.query(models.AssignmentSubmission).filter(
-                models.AssignmentSubmission.assignment_id == assignment.id,
-                models.AssignmentSubmission.student_id == current_user.id
-            ).first()
+        stats = stats_by_assignment[assignment.id]
+        submission = my_submissions.get(assignment.id)
 
         response.append({
             "id": assignment.id,
@@ -1426,12 +2681,138 @@ async def list_assignments(
 
     return response
 
+REVISION_MAX_CHAIN = int(os.getenv("REVISION_MAX_CHAIN", "20"))
+REVISION_DELTA_MAX_RATIO = float(os.getenv("REVISION_DELTA_MAX_RATIO", "0.5"))
+REVISION_TOKEN = re.compile(r"\s+|[^\s<>]+|[<>]")
+
+def _encode_delta(old: str, new: str) -> list:
+    """Ops turning `old` into `new`: ints > 0 copy that many characters,
+    ints < 0 skip them, strings are inserted. Diffed on word tokens."""
+    a = REVISION_TOKEN.findall(old)
+    b = REVISION_TOKEN.findall(new)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(len("".join(a[i1:i2])))
+            continue
+        if i2 > i1:
+            ops.append(-len("".join(a[i1:i2])))
+        if j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return ops
+
+def _apply_delta(old: str, ops: list) -> str:
+    parts = []
+    pos = 0
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(old[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return "".join(parts)
+
+def _record_submission_revision(
+    db: Session,
+    submission_id: int,
+    content: str | None,
+    submitted_at: datetime,
+    is_late: bool,
+    current: models.AssignmentSubmission | None = None
+):
+    """Append `content` as the next revision of a submission.
+
+    `current` is the (locked) row before it is overwritten. Revisions are
+    deltas against the previous one, except for a zlib snapshot every
+    REVISION_MAX_CHAIN revisions or whenever the delta would not be much
+    smaller than a snapshot.
+    """
+    Revision = models.SubmissionRevision
+    latest, last_snapshot = db.query(
+        func.max(Revision.revision),
+        func.max(case((Revision.kind == "snapshot", Revision.revision)))
+    ).filter(Revision.submission_id == submission_id).one()
+
+    previous = None
+    if current is not None:
+        previous = current.content or ""
+        if latest is None:
+            # Saved before revisions were kept: its current text becomes revision 1
+            db.add(Revision(
+                submission_id=submission_id,
+                revision=1,
+                kind="snapshot",
+                data=zlib.compress(previous.encode()),
+                raw_size=len(previous.encode()),
+                submitted_at=current.submitted_at or submitted_at,
+                is_late=current.is_late
+            ))
+            latest = last_snapshot = 1
+
+    text_value = content or ""
+    raw = text_value.encode()
+    kind = "snapshot"
+    data = zlib.compress(raw)
+    if latest is not None and latest - last_snapshot + 1 < REVISION_MAX_CHAIN:
+        delta = zlib.compress(json.dumps(_encode_delta(previous, text_value), separators=(",", ":")).encode())
+        if len(delta) < len(data) * REVISION_DELTA_MAX_RATIO:
+            kind = "delta"
+            data = delta
+
+    db.add(Revision(
+        submission_id=submission_id,
+        revision=(latest or 0) + 1,
+        kind=kind,
+        data=data,
+        raw_size=len(raw),
+        submitted_at=submitted_at,
+        is_late=is_late
+    ))
+
+def _reconstruct_revision(db: Session, submission_id: int, revision: int) -> str | None:
+    """Text of one revision: its nearest snapshot with the deltas after it applied"""
+    Revision = models.SubmissionRevision
+    base = db.query(func.max(Revision.revision)).filter(
+        Revision.submission_id == submission_id,
+        Revision.kind == "snapshot",
+        Revision.revision <= revision
+    ).scalar()
+    if base is None:
+        return None
+    chain = db.query(Revision).filter(
+        Revision.submission_id == submission_id,
+        Revision.revision >= base,
+        Revision.revision <= revision
+    ).order_by(Revision.revision.asc()).all()
+    if not chain or chain[-1].revision != revision:
+        return None
+
+    text_value = ""
+    for entry in chain:
+        data = zlib.decompress(entry.data)
+        if entry.kind == "snapshot":
+            text_value = data.decode()
+        else:
+            text_value = _apply_delta(text_value, json.loads(data))
+    return text_value
+
+def _revision_storage_stats(raw_bytes: int, stored_bytes: int) -> dict:
+    return {
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "compression_ratio": round(raw_bytes / stored_bytes, 2) if stored_bytes else None
+    }
+
 @app.post("/api/assignments/{assignment_id}/submit")
 async def submit_assignment(
     assignment_id: int,
     submission: schemas.AssignmentSubmissionCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     if current_user.role != models.UserRole.STUDENT:
         raise HTTPException(status_code=403, detail="Only students can submit assignments")
@@ -1440,60 +2821,82 @@ async def submit_assignment(
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
 
-    _ensure_class_access(db, current_user, assignment.class_id)
+    access.ensure_class_access(assignment.class_id)
 
-    submitted_at = datetime.utcnow()
+    submitted_at = datetime.now(timezone.utc)
     is_late = assignment.due_date is not None and submitted_at > assignment.due_date
     if is_late and not assignment.allow_late:
         raise HTTPException(status_code=400, detail="Late submissions are not allowed")
 
-    existing = db.query(models.AssignmentSubmission).filter(
-        models.AssignmentSubmission.assignment_id == assignment_id,
-        models.AssignmentSubmission.student_id == current_user.id
-    ).first()
+    def lock_existing():
+        return db.query(models.AssignmentSubmission).filter(
+            models.AssignmentSubmission.assignment_id == assignment_id,
+            models.AssignmentSubmission.student_id == current_user.id
+        ).with_for_update().first()
+
+    existing = lock_existing()
+    if not existing:
+        # Insert unless a concurrent request got there first; the unique
+        # (assignment_id, student_id) constraint makes this race-free
+        inserted = db.execute(
+            pg_insert(models.AssignmentSubmission.__table__).values(
+                assignment_id=assignment_id,
+                student_id=current_user.id,
+                submitted_at=submitted_at,
+                content=submission.content,
+                is_late=is_late
+            ).on_conflict_do_nothing(
+                index_elements=["assignment_id", "student_id"]
+            ).returning(models.AssignmentSubmission.id)
+        ).first()
+        if inserted:
+            _record_submission_revision(db, inserted.id, submission.content, submitted_at, is_late)
+            _record_event(db, current_user.id, assignment.class_id, "submission", assignment.id)
+            _record_class_activity(db, assignment.class_id, current_user, "submissions")
+            _record_student_activity(db, assignment.class_id, current_user.id, {
+                "submissions": 1,
+                "on_time_submissions": int(not is_late)
+            })
+            db.commit()
+            saved = db.query(models.AssignmentSubmission).filter(
+                models.AssignmentSubmission.id == inserted.id
+            ).first()
+        else:
+            existing = lock_existing()
 
     if existing:
+        on_time_delta = int(not is_late) - int(not existing.is_late)
+        _record_submission_revision(db, existing.id, submission.content, submitted_at, is_late, current=existing)
         existing.content = submission.content
         existing.submitted_at = submitted_at
         existing.is_late = is_late
+        _record_event(db, current_user.id, assignment.class_id, "submission", assignment.id)
+        _record_class_activity(db, assignment.class_id, current_user)
+        _record_student_activity(db, assignment.class_id, current_user.id, {"on_time_submissions": on_time_delta})
         db.commit()
         db.refresh(existing)
-        return {
-            "id": existing.id,
-            "assignment_id": existing.assignment_id,
-            "student_id": existing.student_id,
-            "submitted_at": existing.submitted_at,
-            "content": existing.content,
-            "is_late": existing.is_late
-        }
+        saved = existing
 
-    new_submission = models.AssignmentSubmission(
-        assignment_id=assignment_id,
-        student_id=current_user.id,
-        submitted_at=submitted_at,
-        content=submission.content,
-        is_late=is_late
-    )
-    db.add(new_submission)
-    db.commit()
-    db.refresh(new_submission)
     return {
-        "id": new_submission.id,
-        "assignment_id": new_submission.assignment_id,
-        "student_id": new_submission.student_id,
-        "submitted_at": new_submission.submitted_at,
-        "content": new_submission.content,
-        "is_late": new_submission.is_late
+        "id": saved.id,
+        "assignment_id": saved.assignment_id,
+        "student_id": saved.student_id,
+        "submitted_at": saved.submitted_at,
+        "content": saved.content,
+        "is_late": saved.is_late
     }
 
-@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions")
-async def list_assignment_submissions(
+SUBMISSIONS_PAGE_LIMIT = int(os.getenv("SUBMISSIONS_PAGE_LIMIT", "200"))
+
+def _get_viewable_assignment(
+    db: Session,
     class_id: int,
     assignment_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
-):
-    db_class = _get_class_or_404(db, class_id)
+    current_user: models.User,
+    access: AccessContext
+) -> models.Assignment:
+    """Assignment whose submissions the caller may read, or raise 404/403"""
+    db_class = access.get_class_or_404(class_id)
     assignment = db.query(models.Assignment).filter(models.Assignment.id == assignment_id).first()
     if not assignment or assignment.class_id != class_id:
         raise HTTPException(status_code=404, detail="Assignment not found")
@@ -1501,63 +2904,562 @@ async def list_assignment_submissions(
     if current_user.role == models.UserRole.ADMIN:
         pass
     elif current_user.role == models.UserRole.TEACHER:
-        teacher = _get_teacher_record(db, current_user)
-        if not teacher or db_class.teacher_id != teacher.id:
+        if not access.is_class_teacher(db_class):
             raise HTTPException(status_code=403, detail="Not authorized")
     elif current_user.role == models.UserRole.STUDENT:
-        _ensure_class_access(db, current_user, class_id)
+        access.ensure_class_access(class_id)
         if assignment.visibility != "class":
             raise HTTPException(status_code=403, detail="Not authorized")
     else:
         raise HTTPException(status_code=403, detail="Not authorized")
-    submissions = db.query(models.AssignmentSubmission).filter(
+    return assignment
+
+def _submission_response(submission: models.AssignmentSubmission, student: models.User | None, include_content: bool = True) -> dict:
+    result = {
+        "id": submission.id,
+        "assignment_id": submission.assignment_id,
+        "student_id": submission.student_id,
+        "submitted_at": submission.submitted_at,
+        "is_late": submission.is_late,
+        "student": {
+            "id": student.id,
+            "first_name": student.first_name,
+            "last_name": student.last_name,
+            "email": student.email,
+            "username": student.username
+        } if student else None
+    }
+    if include_content:
+        result["content"] = submission.content
+    return result
+
+@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions")
+async def list_assignment_submissions(
+    class_id: int,
+    assignment_id: int,
+    after_id: int | None = None,
+    limit: int | None = None,
+    summary: bool = False,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """Submissions in id order.
+
+    Without `limit` or `after_id` every submission comes back as a plain
+    list, as it always has. With either, one page of at most
+    SUBMISSIONS_PAGE_LIMIT comes back as {submissions, next_cursor,
+    has_more}; pass next_cursor as after_id for the next page. The cursor is
+    the last id, since submitted_at moves on resubmission.
+
+    With summary=true the content bodies are left out; fetch them one at a
+    time from the single-submission endpoint.
+    """
+    _get_viewable_assignment(db, class_id, assignment_id, current_user, access)
+    paged = limit is not None or after_id is not None
+
+    # Students come from the same outer-joined query instead of one lookup each
+    query = db.query(models.AssignmentSubmission, models.User).outerjoin(
+        models.User, models.User.id == models.AssignmentSubmission.student_id
+    ).filter(
         models.AssignmentSubmission.assignment_id == assignment_id
-    ).all()
+    )
+    if after_id is not None:
+        query = query.filter(models.AssignmentSubmission.id > after_id)
+    if summary:
+        query = query.options(defer(models.AssignmentSubmission.content))
+    query = query.order_by(models.AssignmentSubmission.id.asc())
+    if not paged:
+        return [
+            _submission_response(submission, student, include_content=not summary)
+            for submission, student in query.all()
+        ]
 
-    results = []
-    for submission in submissions:
-        student = db.query(models.User).filter(models.User.id == submission.student_id).first()
-        results.append({
-            "id": submission.id,
-            "assignment_id": submission.assignment_id,
-            "student_id": submission.student_id,
-            "submitted_at": submission.submitted_at,
-            "content": submission.content,
-            "is_late": submission.is_late,
-            "student": {
-                "id": student.id,
-                "first_name": student.first_name,
-                "last_name": student.last_name,
-                "email": student.email,
-                "username": student.username
-            } if student else None
-        })
+    limit = max(1, min(limit or SUBMISSIONS_PAGE_LIMIT, SUBMISSIONS_PAGE_LIMIT))
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "submissions": [
+            _submission_response(submission, student, include_content=not summary)
+            for submission, student in rows
+        ],
+        "next_cursor": rows[-1][0].id if has_more else None,
+        "has_more": has_more
+    }
+
+GRADEBOOK_STATUSES = ("missing", "on_time", "late")
+
+@app.get("/api/classes/{class_id}/gradebook")
+async def get_class_gradebook(
+    class_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """Roster x assignments submission grid for a class.
+
+    `matrix[i][j]` is the status of `students[i]` on `assignments[j]`, as an
+    index into `statuses`.
+    """
+    db_class = access.get_class_or_404(class_id)
+    if current_user.role != models.UserRole.ADMIN and not access.is_class_teacher(db_class):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    # Every (student, assignment) pair with its submission, if any. Outer joins
+    # keep the roster when there are no assignments and vice versa.
+    rows = db.query(
+        models.User.id,
+        models.User.first_name,
+        models.User.last_name,
+        models.User.username,
+        models.Assignment.id,
+        models.Assignment.title,
+        models.Assignment.due_date,
+        models.AssignmentSubmission.id,
+        models.AssignmentSubmission.is_late
+    ).select_from(models.Class).outerjoin(
+        models.ClassEnrollment, models.ClassEnrollment.class_id == models.Class.id
+    ).outerjoin(
+        models.User, models.User.id == models.ClassEnrollment.student_id
+    ).outerjoin(
+        models.Assignment, models.Assignment.class_id == models.Class.id
+    ).outerjoin(
+        models.AssignmentSubmission, and_(
+            models.AssignmentSubmission.assignment_id == models.Assignment.id,
+            models.AssignmentSubmission.student_id == models.ClassEnrollment.student_id
+        )
+    ).filter(models.Class.id == class_id).all()
+
+    students = {}
+    assignments = {}
+    statuses = {}
+    for (student_id, first_name, last_name, username,
+         assignment_id, title, due_date, submission_id, is_late) in rows:
+        if student_id is not None:
+            students[student_id] = (first_name, last_name, username)
+        if assignment_id is not None:
+            assignments[assignment_id] = (title, due_date)
+        if submission_id is not None:
+            statuses[(student_id, assignment_id)] = 2 if is_late else 1
+
+    student_ids = sorted(students, key=lambda sid: (
+        (students[sid][1] or "").lower(), (students[sid][0] or "").lower(), sid
+    ))
+    assignment_ids = sorted(assignments, key=lambda aid: (
+        assignments[aid][1] is None, assignments[aid][1] or datetime.min.replace(tzinfo=timezone.utc), aid
+    ))
+
+    return {
+        "class_id": class_id,
+        "statuses": GRADEBOOK_STATUSES,
+        "students": [
+            [sid, students[sid][0], students[sid][1], students[sid][2]]
+            for sid in student_ids
+        ],
+        "assignments": [
+            [aid, assignments[aid][0], assignments[aid][1]]
+            for aid in assignment_ids
+        ],
+        "matrix": [
+            [statuses.get((sid, aid), 0) for aid in assignment_ids]
+            for sid in student_ids
+        ]
+    }
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _stream_export(build_query, columns: tuple, fmt: str):
+    """Yield CSV or NDJSON lines for the rows of `build_query(session)`.
+
+    Runs with its own session, since the request session is gone by the
+    time the body is streamed, and pulls rows through a server-side cursor
+    in EXPORT_BATCH_SIZE batches so memory stays flat.
+    """
+    db = SessionLocal()
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def csv_line(values):
+            writer.writerow(values)
+            line = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return line
+
+        if fmt == "csv":
+            yield csv_line(columns)
+        for row in build_query(db).yield_per(EXPORT_BATCH_SIZE):
+            values = [_export_value(value) for value in row]
+            if fmt == "csv":
+                yield csv_line(values)
+            else:
+                yield json.dumps(dict(zip(columns, values))) + "\n"
+    finally:
+        db.close()
+
+def _export_response(build_query, columns: tuple, fmt: str, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        _stream_export(build_query, columns, fmt),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+def _ensure_export_access(db_class: models.Class, current_user: models.User, access: AccessContext, fmt: str):
+    if fmt not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    if current_user.role != models.UserRole.ADMIN and not access.is_class_teacher(db_class):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions/export")
+async def export_assignment_submissions(
+    class_id: int,
+    assignment_id: int,
+    format: str = "csv",
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """Every submission of an assignment with its student and content"""
+    assignment = _get_viewable_assignment(db, class_id, assignment_id, current_user, access)
+    _ensure_export_access(access.get_class_or_404(class_id), current_user, access, format)
+
+    columns = (
+        "submission_id", "student_id", "first_name", "last_name", "username",
+        "email", "submitted_at", "is_late", "content"
+    )
+
+    def build_query(session: Session):
+        return session.query(
+            models.AssignmentSubmission.id,
+            models.User.id,
+            models.User.first_name,
+            models.User.last_name,
+            models.User.username,
+            models.User.email,
+            models.AssignmentSubmission.submitted_at,
+            models.AssignmentSubmission.is_late,
+            models.AssignmentSubmission.content
+        ).outerjoin(
+            models.User, models.User.id == models.AssignmentSubmission.student_id
+        ).filter(
+            models.AssignmentSubmission.assignment_id == assignment_id
+        ).order_by(models.AssignmentSubmission.id.asc())
+
+    return _export_response(build_query, columns, format, f"assignment-{assignment.id}-submissions")
+
+@app.get("/api/classes/{class_id}/gradebook/export")
+async def export_class_gradebook(
+    class_id: int,
+    format: str = "csv",
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """One row per enrolled student and assignment, with the submission status"""
+    _ensure_export_access(access.get_class_or_404(class_id), current_user, access, format)
+
+    columns = (
+        "student_id", "first_name", "last_name", "username", "assignment_id",
+        "assignment_title", "due_date", "status", "submitted_at"
+    )
+
+    def build_query(session: Session):
+        return session.query(
+            models.User.id,
+            models.User.first_name,
+            models.User.last_name,
+            models.User.username,
+            models.Assignment.id,
+            models.Assignment.title,
+            models.Assignment.due_date,
+            case(
+                (models.AssignmentSubmission.id.is_(None), GRADEBOOK_STATUSES[0]),
+                (models.AssignmentSubmission.is_late, GRADEBOOK_STATUSES[2]),
+                else_=GRADEBOOK_STATUSES[1]
+            ),
+            models.AssignmentSubmission.submitted_at
+        ).select_from(models.ClassEnrollment).join(
+            models.User, models.User.id == models.ClassEnrollment.student_id
+        ).join(
+            models.Assignment, models.Assignment.class_id == models.ClassEnrollment.class_id
+        ).outerjoin(
+            models.AssignmentSubmission, and_(
+                models.AssignmentSubmission.assignment_id == models.Assignment.id,
+                models.AssignmentSubmission.student_id == models.ClassEnrollment.student_id
+            )
+        ).filter(
+            models.ClassEnrollment.class_id == class_id
+        ).order_by(
+            models.User.last_name.asc(),
+            models.User.first_name.asc(),
+            models.User.id.asc(),
+            models.Assignment.due_date.asc().nulls_last(),
+            models.Assignment.id.asc()
+        )
+
+    return _export_response(build_query, columns, format, f"class-{class_id}-gradebook")
+
+@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions/{submission_id}")
+async def get_assignment_submission(
+    class_id: int,
+    assignment_id: int,
+    submission_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    _get_viewable_assignment(db, class_id, assignment_id, current_user, access)
+    row = db.query(models.AssignmentSubmission, models.User).outerjoin(
+        models.User, models.User.id == models.AssignmentSubmission.student_id
+    ).filter(
+        models.AssignmentSubmission.id == submission_id,
+        models.AssignmentSubmission.assignment_id == assignment_id
+    ).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    return _submission_response(*row)
+
+def _get_viewable_submission(
+    db: Session,
+    class_id: int,
+    assignment_id: int,
+    submission_id: int,
+    current_user: models.User,
+    access: AccessContext
+) -> models.AssignmentSubmission:
+    _get_viewable_assignment(db, class_id, assignment_id, current_user, access)
+    submission = db.query(models.AssignmentSubmission).filter(
+        models.AssignmentSubmission.id == submission_id,
+        models.AssignmentSubmission.assignment_id == assignment_id
+    ).first()
+    if not submission:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    return submission
+
+@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions/{submission_id}/revisions")
+async def list_submission_revisions(
+    class_id: int,
+    assignment_id: int,
+    submission_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    _get_viewable_submission(db, class_id, assignment_id, submission_id, current_user, access)
+    Revision = models.SubmissionRevision
+    revisions = db.query(
+        Revision.revision,
+        Revision.kind,
+        Revision.submitted_at,
+        Revision.is_late,
+        Revision.raw_size,
+        func.length(Revision.data)
+    ).filter(
+        Revision.submission_id == submission_id
+    ).order_by(Revision.revision.asc()).all()
+
+    return {
+        "submission_id": submission_id,
+        "revisions": [
+            {
+                "revision": revision,
+                "kind": kind,
+                "submitted_at": submitted_at,
+                "is_late": is_late,
+                "raw_size": raw_size,
+                "stored_size": stored_size
+            }
+            for revision, kind, submitted_at, is_late, raw_size, stored_size in revisions
+        ],
+        "storage": _revision_storage_stats(
+            sum(row[4] for row in revisions),
+            sum(row[5] for row in revisions)
+        )
+    }
+
+@app.get("/api/classes/{class_id}/assignments/{assignment_id}/submissions/{submission_id}/revisions/{revision}")
+async def get_submission_revision(
+    class_id: int,
+    assignment_id: int,
+    submission_id: int,
+    revision: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    _get_viewable_submission(db, class_id, assignment_id, submission_id, current_user, access)
+    content = _reconstruct_revision(db, submission_id, revision)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    entry = db.query(models.SubmissionRevision).filter(
+        models.SubmissionRevision.submission_id == submission_id,
+        models.SubmissionRevision.revision == revision
+    ).first()
+    return {
+        "submission_id": submission_id,
+        "revision": revision,
+        "submitted_at": entry.submitted_at,
+        "is_late": entry.is_late,
+        "content": content
+    }
+
+@app.get("/api/admin/revisions/stats")
+async def get_revision_storage_stats(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """How much the delta/snapshot encoding saves across all submissions"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    Revision = models.SubmissionRevision
+    rows = db.query(
+        Revision.kind,
+        func.count(Revision.id),
+        func.coalesce(func.sum(Revision.raw_size), 0),
+        func.coalesce(func.sum(func.length(Revision.data)), 0)
+    ).group_by(Revision.kind).all()
+
+    by_kind = {
+        kind: {"revisions": count, **_revision_storage_stats(int(raw_bytes), int(stored_bytes))}
+        for kind, count, raw_bytes, stored_bytes in rows
+    }
+    return {
+        "revisions": sum(entry["revisions"] for entry in by_kind.values()),
+        **_revision_storage_stats(
+            sum(entry["raw_bytes"] for entry in by_kind.values()),
+            sum(entry["stored_bytes"] for entry in by_kind.values())
+        ),
+        "by_kind": by_kind
+    }
 
-    return results
+ANALYTICS_MAX_STALENESS = int(os.getenv("ANALYTICS_MAX_STALENESS", "60"))
+ANALYTICS_MAX_AGE = int(os.getenv("ANALYTICS_MAX_AGE", "900"))
+
+class AnalyticsSnapshotCache:
+    """Stale-while-revalidate cache of analytics snapshots.
+
+    Snapshots younger than `max_staleness` are served as is. Older ones are
+    still served while a single background task recomputes them, until they
+    pass `max_age` and the caller waits for a fresh one. Concurrent misses on
+    one key share the same computation. Each invalidation starts a new
+    generation; a computation started before its key was invalidated still
+    answers its waiters but is not stored. Lives on the event loop only.
+    """
+
+    def __init__(self, max_staleness: int = ANALYTICS_MAX_STALENESS, max_age: int = ANALYTICS_MAX_AGE):
+        self.max_staleness = max_staleness
+        self.max_age = max_age
+        self._snapshots = {}
+        self._inflight = {}
+        self._generation = 0
+        self._invalidated_at = {}  # key -> generation of its last invalidation
+
+    async def get(self, key: tuple, compute) -> dict:
+        """Return the snapshot for `key`; `compute(session)` builds a new one"""
+        snapshot = self._snapshots.get(key)
+        if snapshot:
+            age = time.monotonic() - snapshot[0]
+            if age < self.max_staleness:
+                return snapshot[1]
+            if age < self.max_age:
+                self._refresh(key, compute)
+                return snapshot[1]
+        return await asyncio.shield(self._refresh(key, compute))
+
+    def _refresh(self, key: tuple, compute) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._recompute(key, compute))
+            # Background refreshes may fail unobserved; the error is already logged
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _recompute(self, key: tuple, compute) -> dict:
+        generation = self._generation
+        task = asyncio.current_task()
+        try:
+            data = await asyncio.to_thread(self._run, compute)
+            data["as_of"] = datetime.utcnow()
+            if self._invalidated_at.get(key, 0) <= generation:
+                self._snapshots[key] = (time.monotonic(), data)
+            return data
+        except Exception as e:
+            print(f"Analytics refresh error for {key}: {str(e)}")
+            raise
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+
+    @staticmethod
+    def _run(compute) -> dict:
+        db = SessionLocal()
+        try:
+            return compute(db)
+        finally:
+            db.close()
+
+    def invalidate(self, kind: str | None = None, object_id: int | None = None) -> int:
+        """Drop snapshots so the next read recomputes, fencing off refreshes
+        already running for them; returns how many snapshots were dropped"""
+        def matches(key: tuple) -> bool:
+            return (kind is None or key[0] == kind) and (object_id is None or key[1] == object_id)
+
+        self._generation += 1
+        keys = [key for key in self._snapshots if matches(key)]
+        for key in keys:
+            del self._snapshots[key]
+        for key in [key for key in self._inflight if matches(key)] + keys:
+            self._inflight.pop(key, None)
+            self._invalidated_at[key] = self._generation
+        return len(keys)
+
+analytics_cache = AnalyticsSnapshotCache()
 
 @app.get("/api/classes/{class_id}/analytics")
 async def get_class_analytics(
     class_id: int,
+    days: int = 7,
+    bucket: str = "day",
+    tz: str | None = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
-    db_class = _ensure_class_access(db, current_user, class_id)
+    db_class = access.ensure_class_access(class_id)
 
     if current_user.role == models.UserRole.STUDENT:
         raise HTTPException(status_code=403, detail="Not authorized")
 
+    tz = tz or SCHOOL_TIMEZONE
+    _validate_post_trend(days, bucket, tz)
+
+    class_name = db_class.name
+    return await analytics_cache.get(
+        ("class", class_id, days, bucket, tz),
+        lambda session: _compute_class_analytics(session, class_id, class_name, days, bucket, tz)
+    )
+
+def _compute_class_analytics(
+    db: Session,
+    class_id: int,
+    class_name: str,
+    days: int,
+    bucket: str,
+    tz: str
+) -> dict:
     total_students = _get_class_student_count(db, class_id)
-    total_posts = db.query(models.Blog).filter(models.Blog.class_id == class_id).count()
-    last_week = datetime.utcnow() - timedelta(days=7)
-    posts_last_week = db.query(models.Blog).filter(
-        models.Blog.class_id == class_id,
-        models.Blog.created_at >= last_week
-    ).count()
-    start_of_day = datetime.combine(datetime.utcnow().date(), datetime.min.time())
-    active_today = db.query(models.Blog.owner_id).filter(
-        models.Blog.class_id == class_id,
-        models.Blog.created_at >= start_of_day
-    ).distinct().count()
+    activity = _get_class_post_activity(db, [class_id])[class_id]
+    total_posts = activity["posts"]
+    posts_last_week = activity["posts_last_week"]
+    active_today = activity["active_today"]
 
     assignments = db.query(models.Assignment).filter(models.Assignment.class_id == class_id).all()
     assignments_total = len(assignments)
@@ -1566,9 +3468,10 @@ async def get_class_analytics(
     late_total = 0
     missing_total = 0
     assignment_stats = []
+    stats_by_assignment = _get_assignment_stats_batch(db, assignments, {class_id: total_students})
 
     for assignment in assignments:
-        stats = _get_assignment_stats(db, assignment, total_students)
+        stats = stats_by_assignment[assignment.id]
         submissions_total += stats["submitted"]
         on_time_total += stats["on_time"]
         late_total += stats["late"]
@@ -1590,11 +3493,15 @@ async def get_class_analytics(
     else:
         engagement_rate = 0
 
-    post_trend = _get_post_counts_last_days(db, class_id, days=7)
+    post_trend = _get_post_counts_last_days(db, class_id, days=days, tz=tz, bucket=bucket)
+    if (days, bucket) == (7, "day"):
+        posts_last_7_days = post_trend
+    else:
+        posts_last_7_days = _get_post_counts_last_days(db, class_id, days=7, tz=tz)
 
     return {
         "class_id": class_id,
-        "class_name": db_class.name,
+        "class_name": class_name,
         "total_students": total_students,
         "total_posts": total_posts,
         "posts_last_week": posts_last_week,
@@ -1606,18 +3513,25 @@ async def get_class_analytics(
         "late_total": late_total,
         "missing_total": missing_total,
         "assignment_stats": assignment_stats,
-        "posts_last_7_days": post_trend
+        "posts_last_7_days": posts_last_7_days,
+        "post_trend": {
+            "days": days,
+            "bucket": bucket,
+            "timezone": tz,
+            "points": post_trend
+        }
     }
 
 @app.get("/api/teacher/analytics")
 async def get_teacher_analytics(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     if current_user.role != models.UserRole.TEACHER:
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    teacher = _get_teacher_record(db, current_user)
+    teacher = access.teacher()
     if not teacher:
         return {
             "classes": [],
@@ -1630,10 +3544,19 @@ async def get_teacher_analytics(
                 "on_time": 0,
                 "late": 0,
                 "missing": 0
-            }
+            },
+            "as_of": datetime.utcnow()
         }
 
-    classes = db.query(models.Class).filter(models.Class.teacher_id == teacher.id).all()
+    teacher_id = teacher.id
+    return await analytics_cache.get(
+        ("teacher", teacher_id),
+        lambda session: _compute_teacher_analytics(session, teacher_id)
+    )
+
+def _compute_teacher_analytics(db: Session, teacher_id: int) -> dict:
+    classes = db.query(models.Class).filter(models.Class.teacher_id == teacher_id).all()
+    class_ids = [class_.id for class_ in classes]
     class_reports = []
 
     totals = {
@@ -1651,39 +3574,45 @@ async def get_teacher_analytics(
 
     engagement_sum = 0
 
+    # Every figure below comes from a fixed set of queries grouped by class_id
+    student_counts = _get_class_student_counts(db, class_ids)
+    post_activity = _get_class_post_activity(db, class_ids)
+    assignments = db.query(models.Assignment).filter(
+        models.Assignment.class_id.in_(class_ids)
+    ).all() if class_ids else []
+    stats_by_assignment = _get_assignment_stats_batch(db, assignments, student_counts)
+
+    assignments_by_class = {class_id: [] for class_id in class_ids}
+    for assignment in assignments:
+        assignments_by_class[assignment.class_id].append(assignment)
+
     for class_ in classes:
-        total_students = _get_class_student_count(db, class_.id)
-        total_posts = db.query(models.Blog).filter(models.Blog.class_id == class_.id).count()
-        assignments = db.query(models.Assignment).filter(models.Assignment.class_id == class_.id).all()
-        start_of_day = datetime.combine(datetime.utcnow().date(), datetime.min.time())
-        active_today = db.query(models.Blog.owner_id).filter(
-            models.Blog.class_id == class_.id,
-            models.Blog.created_at >= start_of_day
-        ).distinct().count()
+        total_students = student_counts[class_.id]
+        activity = post_activity[class_.id]
+        total_posts = activity["posts"]
+        active_today = activity["active_today"]
+        class_assignments = assignments_by_class[class_.id]
         submissions_total = 0
         on_time_total = 0
         late_total = 0
         missing_total = 0
 
-        for assignment in assignments:
-            stats = _get_assignment_stats(db, assignment, total_students)
+        for assignment in class_assignments:
+            stats = stats_by_assignment[assignment.id]
             submissions_total += stats["submitted"]
             on_time_total += stats["on_time"]
             late_total += stats["late"]
             missing_total += stats["missing"]
 
-        if len(assignments) > 0 and total_students > 0:
+        if len(class_assignments) > 0 and total_students > 0:
             class_engagement = min(
                 100,
-                round((submissions_total / (len(assignments) * total_students)) * 100)
+                round((submissions_total / (len(class_assignments) * total_students)) * 100)
             )
         elif total_students > 0:
             class_engagement = min(
                 100,
-                round((db.query(models.Blog).filter(
-                    models.Blog.class_id == class_.id,
-                    models.Blog.created_at >= datetime.utcnow() - timedelta(days=7)
-                ).count() / total_students) * 100)
+                round((activity["posts_last_week"] / total_students) * 100)
             )
         else:
             class_engagement = 0
@@ -1693,7 +3622,7 @@ async def get_teacher_analytics(
             "class_name": class_.name,
             "students": total_students,
             "posts": total_posts,
-            "assignments": len(assignments),
+            "assignments": len(class_assignments),
             "submissions": submissions_total,
             "on_time": on_time_total,
             "late": late_total,
@@ -1704,7 +3633,7 @@ async def get_teacher_analytics(
 
         totals["students"] += total_students
         totals["posts"] += total_posts
-        totals["assignments"] += len(assignments)
+        totals["assignments"] += len(class_assignments)
         totals["submissions"] += submissions_total
         totals["on_time"] += on_time_total
         totals["late"] += late_total
@@ -1719,6 +3648,25 @@ async def get_teacher_analytics(
         "totals": totals
     }
 
+@app.post("/api/admin/analytics/refresh")
+async def refresh_analytics(
+    refresh_data: dict | None = None,
+    current_user: models.User = Depends(get_current_user)
+):
+    """Force analytics snapshots to be recomputed on their next read (admins only)"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    refresh_data = refresh_data or {}
+    if "class_id" in refresh_data:
+        dropped = analytics_cache.invalidate("class", refresh_data["class_id"])
+    elif "teacher_id" in refresh_data:
+        dropped = analytics_cache.invalidate("teacher", refresh_data["teacher_id"])
+    else:
+        dropped = analytics_cache.invalidate()
+    
+    return {"invalidated": dropped}
+
 @app.get("/api/classes/{class_id}/posts/{post_id}")
 async def get_class_post(
     class_id: int,
@@ -1728,11 +3676,7 @@ async def get_class_post(
 ):
     # Check access rights
     if current_user.role == models.UserRole.STUDENT:
-        enrollment = db.query(models.ClassEnrollment).filter(
-            models.ClassEnrollment.student_id == current_user.id,
-            models.ClassEnrollment.class_id == class_id
-        ).first()
-        if not enrollment:
+        if not membership_index.is_enrolled(db, current_user.id, class_id):
             raise HTTPException(status_code=403, detail="Not enrolled in this class")
     
     post = db.query(models.Blog).filter(
@@ -1754,7 +3698,7 @@ async def get_class_post(
             "first_name": author.first_name,
             "last_name": author.last_name
         },
-        "content": post.content  # Content already includes the markers
+        "content": _sign_media_urls(post.content, f"class:{class_id}")  # Content already includes the markers
     }
 
 @app.put("/api/classes/{class_id}/posts/{post_id}")
@@ -1780,7 +3724,7 @@ async def update_class_post(
     
     # Update the post - make sure title and content are both updated
     db_post.title = post.title
-    db_post.content = post.content
+    db_post.content = _unsign_media_urls(post.content)
     db_post.updated_at = datetime.utcnow()
     
     db.commit()
@@ -1790,7 +3734,7 @@ async def update_class_post(
     return {
         "id": db_post.id,
         "title": db_post.title,  # Make sure title is returned
-        "content": db_post.content,
+        "content": _sign_media_urls(db_post.content, f"class:{db_post.class_id}"),
         "created_at": db_post.created_at,
         "owner_id": db_post.owner_id,
         "class_id": db_post.class_id,
@@ -1820,6 +3764,8 @@ async def delete_class_post(
         raise HTTPException(status_code=403, detail="Not authorized to delete this post")
     
     # Delete the post
+    _record_class_activity(db, class_id, None, "posts", delta=-1, moment=post.created_at)
+    _record_student_activity(db, class_id, post.owner_id, {"posts": -1}, active=False)
     db.delete(post)
     db.commit()
     
@@ -1899,10 +3845,81 @@ async def join_class(
     )
     
     db.add(enrollment)
+    _record_event(db, current_user.id, class_.id, "enrollment", class_.id)
     db.commit()
+    membership_index.enrollment_changed(current_user.id, class_.id)
     
     return {"message": "Successfully joined class"}
 
+STUDENT_DEADLINE_MAX_DAYS = 365
+
+@app.get("/api/student/deadlines")
+async def get_student_deadlines(
+    days_ahead: int = 14,
+    days_back: int = 14,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Upcoming and overdue assignments across the student's active classes.
+
+    Upcoming covers assignments due in the next `days_ahead` days, whether
+    submitted or not; overdue covers unsubmitted ones that fell due in the
+    last `days_back` days.
+    """
+    if current_user.role != models.UserRole.STUDENT:
+        raise HTTPException(status_code=403, detail="Not a student")
+    days_ahead = max(0, min(days_ahead, STUDENT_DEADLINE_MAX_DAYS))
+    days_back = max(0, min(days_back, STUDENT_DEADLINE_MAX_DAYS))
+
+    now = datetime.now(timezone.utc)
+    rows = db.query(
+        models.Assignment.id,
+        models.Assignment.title,
+        models.Assignment.due_date,
+        models.Assignment.allow_late,
+        models.Class.id,
+        models.Class.name,
+        models.AssignmentSubmission.id,
+        models.AssignmentSubmission.submitted_at,
+        models.AssignmentSubmission.is_late
+    ).select_from(models.ClassEnrollment).join(
+        models.Class, models.Class.id == models.ClassEnrollment.class_id
+    ).join(
+        models.Assignment, models.Assignment.class_id == models.ClassEnrollment.class_id
+    ).outerjoin(
+        models.AssignmentSubmission, and_(
+            models.AssignmentSubmission.assignment_id == models.Assignment.id,
+            models.AssignmentSubmission.student_id == models.ClassEnrollment.student_id
+        )
+    ).filter(
+        models.ClassEnrollment.student_id == current_user.id,
+        models.Class.status == "active",
+        models.Assignment.due_date >= now - timedelta(days=days_back),
+        models.Assignment.due_date <= now + timedelta(days=days_ahead),
+        (models.Assignment.due_date >= now) | models.AssignmentSubmission.id.is_(None)
+    ).order_by(models.Assignment.due_date.asc(), models.Assignment.id.asc()).all()
+
+    upcoming = []
+    overdue = []
+    for (assignment_id, title, due_date, allow_late, class_id, class_name,
+         submission_id, submitted_at, is_late) in rows:
+        entry = {
+            "id": assignment_id,
+            "title": title,
+            "due_date": due_date,
+            "allow_late": allow_late,
+            "class_id": class_id,
+            "class_name": class_name,
+            "my_submission": {
+                "id": submission_id,
+                "submitted_at": submitted_at,
+                "is_late": is_late
+            } if submission_id is not None else None
+        }
+        (upcoming if due_date >= now else overdue).append(entry)
+
+    return {"upcoming": upcoming, "overdue": overdue}
+
 @app.get("/api/student/posts")
 async def get_student_posts(
     db: Session = Depends(get_db),
@@ -1922,11 +3939,21 @@ async def get_student_posts(
         class_ = db.query(models.Class).filter(models.Class.id == post.class_id).first()
         posts_with_class.append({
             **post.__dict__,
+            "content": _sign_media_urls(post.content, f"class:{post.class_id}"),
             "class_name": class_.name if class_ else "Unknown Class"
         })
     
     return posts_with_class
 
+@app.get("/api/debug/membership-index")
+async def debug_membership_index(
+    current_user: models.User = Depends(get_current_user)
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    return membership_index.stats()
+
 @app.get("/api/debug/post/{post_id}")
 async def debug_post_content(
     post_id: int,
@@ -2006,25 +4033,23 @@ async def upload_profile_image(
 ):
     """Upload profile image"""
     try:
-        # Create directory if it doesn't exist
-        upload_dir = Path("uploads/profile_images")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
         # Generate unique filename
         file_extension = file.filename.split(".")[-1]
         unique_filename = f"{current_user.id}_{int(datetime.now().timestamp())}.{file_extension}"
-        file_path = upload_dir / unique_filename
         
         # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        path = f"profile_images/{unique_filename}"
+        upload = await _store_upload(db, file, "image", current_user, path)
+        variants = _schedule_image_variants(db, file, path, current_user.id, upload["sha256"])
         
         # Update user record in database
         user = db.query(models.User).filter(models.User.id == current_user.id).first()
-        user.profile_image = f"/uploads/profile_images/{unique_filename}"
+        user.profile_image = f"/uploads/{path}"
         db.commit()
         
-        return {"image_url": user.profile_image}
+        return {"image_url": user.profile_image, "variants": variants, **upload}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to upload image: {str(e)}")
@@ -2037,48 +4062,36 @@ async def upload_cover_image(
 ):
     """Upload cover image"""
     try:
-        # Create directory if it doesn't exist
-        upload_dir = Path("uploads/cover_images")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
         # Generate unique filename
         file_extension = file.filename.split(".")[-1]
         unique_filename = f"{current_user.id}_{int(datetime.now().timestamp())}.{file_extension}"
-        file_path = upload_dir / unique_filename
         
         # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        path = f"cover_images/{unique_filename}"
+        upload = await _store_upload(db, file, "image", current_user, path)
+        variants = _schedule_image_variants(db, file, path, current_user.id, upload["sha256"])
         
         # Update user record in database
         user = db.query(models.User).filter(models.User.id == current_user.id).first()
-        user.cover_image = f"/uploads/cover_images/{unique_filename}"
+        user.cover_image = f"/uploads/{path}"
         db.commit()
         
-        return {"image_url": user.cover_image}
+        return {"image_url": user.cover_image, "variants": variants, **upload}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to upload image: {str(e)}")
 
 def _get_user_class_ids(db: Session, user: models.User) -> List[int]:
     if user.role == models.UserRole.STUDENT:
-        return [
-            enrollment.class_id
-            for enrollment in db.query(models.ClassEnrollment)
-            .filter(models.ClassEnrollment.student_id == user.id)
-            .all()
-        ]
+        return sorted(membership_index.student_classes(db, user.id))
 
     if user.role == models.UserRole.TEACHER:
         teacher = _get_teacher_record(db, user)
         if not teacher:
             return []
-        return [
-            class_.id
-            for class_ in db.query(models.Class)
-            .filter(models.Class.teacher_id == teacher.id)
-            .all()
-        ]
+        return sorted(membership_index.teacher_classes(db, teacher.id))
 
     return []
 
@@ -2109,11 +4122,7 @@ def _ensure_class_access(db: Session, current_user: models.User, class_id: int)
         raise HTTPException(status_code=403, detail="Not authorized to access this class")
 
     # Student
-    enrollment = db.query(models.ClassEnrollment).filter(
-        models.ClassEnrollment.student_id == current_user.id,
-        models.ClassEnrollment.class_id == class_id
-    ).first()
-    if not enrollment:
+    if not membership_index.is_enrolled(db, current_user.id, class_id):
         raise HTTPException(status_code=403, detail="Not enrolled in this class")
 
     return db_class
@@ -2123,51 +4132,546 @@ def _get_class_student_count(db: Session, class_id: int) -> int:
         models.ClassEnrollment.class_id == class_id
     ).count()
 
-def _get_assignment_stats(db: Session, assignment: models.Assignment, total_students: int) -> dict:
-    submissions = db.query(models.AssignmentSubmission).filter(
-        models.AssignmentSubmission.assignment_id == assignment.id
-    ).all()
+def _get_class_student_counts(db: Session, class_ids: List[int]) -> dict[int, int]:
+    counts = {class_id: 0 for class_id in class_ids}
+    if class_ids:
+        rows = db.query(
+            models.ClassEnrollment.class_id,
+            func.count(models.ClassEnrollment.id)
+        ).filter(
+            models.ClassEnrollment.class_id.in_(class_ids)
+        ).group_by(models.ClassEnrollment.class_id).all()
+        counts.update(dict(rows))
+    return counts
+
+def _get_class_post_activity(db: Session, class_ids: List[int]) -> dict[int, dict]:
+    """Total posts, posts in the last 7 days and active students today per class.
+
+    Totals and active students come from the class_daily_stats rollup, so
+    their cost does not grow with history. Posts in the last week keep their
+    rolling 7 x 24 hour window, which local-day rows cannot give, and are
+    counted from one index range scan over that week's posts.
+    """
+    activity = {
+        class_id: {"posts": 0, "posts_last_week": 0, "active_today": 0}
+        for class_id in class_ids
+    }
+    if not class_ids:
+        return activity
+
+    today = _local_day()
+    table = models.ClassDailyStats
+    rows = db.query(
+        table.class_id,
+        func.coalesce(func.sum(table.posts), 0),
+        func.coalesce(func.sum(case((table.day == today, table.active_students), else_=0)), 0)
+    ).filter(
+        table.class_id.in_(class_ids)
+    ).group_by(table.class_id).all()
+    for class_id, posts, active_today in rows:
+        activity[class_id]["posts"] = int(posts)
+        activity[class_id]["active_today"] = int(active_today)
+
+    last_week = datetime.now(timezone.utc) - timedelta(days=7)
+    recent = db.query(
+        models.Blog.class_id,
+        func.count(models.Blog.id)
+    ).filter(
+        models.Blog.class_id.in_(class_ids),
+        models.Blog.created_at >= last_week
+    ).group_by(models.Blog.class_id).all()
+    for class_id, posts_last_week in recent:
+        activity[class_id]["posts_last_week"] = posts_last_week
+    return activity
+
+def _get_assignment_stats_batch(
+    db: Session,
+    assignments: List[models.Assignment],
+    student_counts: dict[int, int]
+) -> dict[int, dict]:
+    """Submission stats for many assignments with one grouped query.
+
+    `student_counts` maps class_id to enrolled students and is used for the
+    missing count. Returns stats keyed by assignment id.
+    """
+    counts = {}
+    assignment_ids = [assignment.id for assignment in assignments]
+    if assignment_ids:
+        on_time_case = case(
+            (
+                and_(
+                    models.Assignment.due_date.isnot(None),
+                    models.AssignmentSubmission.submitted_at.isnot(None),
+                    models.AssignmentSubmission.submitted_at <= models.Assignment.due_date
+                ),
+                1
+            ),
+            else_=0
+        )
+        rows = db.query(
+            models.AssignmentSubmission.assignment_id,
+            func.count(models.AssignmentSubmission.id),
+            func.coalesce(func.sum(on_time_case), 0)
+        ).join(
+            models.Assignment,
+            models.Assignment.id == models.AssignmentSubmission.assignment_id
+        ).filter(
+            models.AssignmentSubmission.assignment_id.in_(assignment_ids)
+        ).group_by(models.AssignmentSubmission.assignment_id).all()
+        counts = {assignment_id: (submitted, int(on_time)) for assignment_id, submitted, on_time in rows}
+
+    stats = {}
+    for assignment in assignments:
+        submitted, on_time = counts.get(assignment.id, (0, 0))
+        stats[assignment.id] = {
+            "submitted": submitted,
+            "on_time": on_time,
+            "late": submitted - on_time,
+            "missing": max(student_counts.get(assignment.class_id, 0) - submitted, 0)
+        }
+    return stats
 
-    on_time = 0
-    late = 0
-    for submission in submissions:
-        if assignment.due_date and submission.submitted_at and submission.submitted_at <= assignment.due_date:
-            on_time += 1
-        else:
-            late += 1
+SCHOOL_TIMEZONE = os.getenv("SCHOOL_TIMEZONE", "UTC")
+POST_TREND_WINDOWS = (7, 30, 90)
+POST_TREND_BUCKETS = ("day", "week")
 
-    submitted = len(submissions)
-    missing = max(total_students - submitted, 0)
+def _validate_post_trend(days: int, bucket: str, tz: str) -> None:
+    if days not in POST_TREND_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"days must be one of {list(POST_TREND_WINDOWS)}")
+    if bucket not in POST_TREND_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {list(POST_TREND_BUCKETS)}")
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid timezone")
+
+def _get_post_histogram(
+    db: Session,
+    class_ids: List[int],
+    days: int = 7,
+    tz: str = SCHOOL_TIMEZONE,
+    bucket: str = "day"
+) -> dict[int, list[dict]]:
+    """Post counts per class bucketed by local day or week, gaps filled with zero.
+
+    One grouped query covers every class; buckets follow `tz` rather than
+    UTC midnight and weeks start on Monday like Postgres date_trunc.
+    """
+    zone = ZoneInfo(tz)
+    today = datetime.now(zone).date()
+    first_day = today - timedelta(days=days - 1)
+    step = timedelta(days=7 if bucket == "week" else 1)
+    first_bucket = first_day - timedelta(days=first_day.weekday()) if bucket == "week" else first_day
+    window_start = datetime.combine(first_day, datetime.min.time(), tzinfo=zone)
+
+    counts = {}
+    if class_ids and tz == SCHOOL_TIMEZONE:
+        # The rollup is bucketed by school day, so weeks are summed here
+        rows = db.query(
+            models.ClassDailyStats.class_id,
+            models.ClassDailyStats.day,
+            models.ClassDailyStats.posts
+        ).filter(
+            models.ClassDailyStats.class_id.in_(class_ids),
+            models.ClassDailyStats.day >= first_day
+        ).all()
+        for class_id, day, posts in rows:
+            if bucket == "week":
+                day = day - timedelta(days=day.weekday())
+            counts[(class_id, day)] = counts.get((class_id, day), 0) + posts
+    elif class_ids:
+        bucket_col = func.date_trunc(bucket, func.timezone(tz, models.Blog.created_at)).label("bucket")
+        rows = db.query(
+            models.Blog.class_id,
+            bucket_col,
+            func.count(models.Blog.id)
+        ).filter(
+            models.Blog.class_id.in_(class_ids),
+            models.Blog.created_at >= window_start
+        ).group_by(models.Blog.class_id, literal_column("bucket")).all()
+        counts = {(class_id, bucket_start.date()): count for class_id, bucket_start, count in rows}
+
+    buckets = []
+    day = first_bucket
+    while day <= today:
+        buckets.append(day)
+        day += step
 
     return {
-        "submitted": submitted,
-        "on_time": on_time,
-        "late": late,
-        "missing": missing
+        class_id: [
+            {"date": day.isoformat(), "count": counts.get((class_id, day), 0)}
+            for day in buckets
+        ]
+        for class_id in class_ids
     }
 
-def _get_post_counts_last_days(db: Session, class_id: int, days: int = 7) -> list[dict]:
-    today = datetime.utcnow().date()
-    results = []
-    for offset in range(days - 1, -1, -1):
-        day = today - timedelta(days=offset)
-        start = datetime.combine(day, datetime.min.time())
-        end = start + timedelta(days=1)
-        count = db.query(models.Blog).filter(
-            models.Blog.class_id == class_id,
-            models.Blog.created_at >= start,
-            models.Blog.created_at < end
-        ).count()
-        results.append({
-            "date": day.isoformat(),
-            "count": count
-        })
-    return results
+def _get_post_counts_last_days(
+    db: Session,
+    class_id: int,
+    days: int = 7,
+    tz: str = SCHOOL_TIMEZONE,
+    bucket: str = "day"
+) -> list[dict]:
+    return _get_post_histogram(db, [class_id], days=days, tz=tz, bucket=bucket)[class_id]
+
+ROLLUP_COUNTERS = ("posts", "comments", "likes", "submissions")
+
+def _local_day(moment: datetime | None = None):
+    """School-local calendar day of `moment` (naive values are UTC), default today"""
+    zone = ZoneInfo(SCHOOL_TIMEZONE)
+    if moment is None:
+        return datetime.now(zone).date()
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(zone).date()
+
+def _record_class_activity(
+    db: Session,
+    class_id: int,
+    actor: models.User | None,
+    counter: str | None = None,
+    delta: int = 1,
+    moment: datetime | None = None
+) -> None:
+    """Upsert the class_daily_stats row for one write, inside the caller's transaction.
+
+    `counter` is one of ROLLUP_COUNTERS; a negative delta undoes an earlier
+    write on the day it happened. A student `actor` is marked active that
+    day; teachers' and admins' writes only count toward the counter.
+    """
+    day = _local_day(moment)
+    new_actor = False
+    if actor is not None and actor.role == models.UserRole.STUDENT and delta > 0:
+        inserted = db.execute(
+            pg_insert(models.ClassDailyActor)
+            .values(class_id=class_id, day=day, user_id=actor.id)
+            .on_conflict_do_nothing(index_elements=["class_id", "day", "user_id"])
+            .returning(models.ClassDailyActor.id)
+        ).first()
+        new_actor = inserted is not None
+
+    if counter is None and not new_actor:
+        return
+
+    table = models.ClassDailyStats.__table__
+    values = {name: 0 for name in ROLLUP_COUNTERS}
+    updates = {}
+    if counter is not None:
+        values[counter] = max(delta, 0)
+        updates[counter] = func.greatest(table.c[counter] + delta, 0)
+    if new_actor:
+        updates["active_students"] = table.c.active_students + 1
+
+    stmt = pg_insert(table).values(
+        class_id=class_id,
+        day=day,
+        active_students=1 if new_actor else 0,
+        **values
+    ).on_conflict_do_update(index_elements=["class_id", "day"], set_=updates)
+    db.execute(stmt)
+
+ACTIVITY_EVENT_TYPES = {
+    "post": "Created a post",
+    "comment": "Commented on a post",
+    "like": "Liked a post",
+    "comment_like": "Liked a comment",
+    "submission": "Submitted an assignment",
+    "enrollment": "Joined the class",
+}
+ACTIVITY_PAGE_LIMIT = 100
+
+def _record_event(db: Session, actor_id: int, class_id: int, event_type: str, object_id: int | None = None) -> None:
+    """Append an activity event, committed with the caller's write"""
+    db.add(models.ActivityEvent(
+        actor_id=actor_id,
+        class_id=class_id,
+        event_type=event_type,
+        object_id=object_id
+    ))
+
+def _list_events(
+    db: Session,
+    before_id: int | None,
+    limit: int,
+    class_ids: List[int] | None = None,
+    actor_id: int | None = None,
+    viewer_id: int | None = None,
+    taught_class_ids: List[int] | None = None
+) -> dict:
+    """Reverse-chronological page of events keyed on id; pass `next_before_id` back for the next page.
+
+    With `viewer_id`, submissions to assignments whose submissions are not
+    shown to the class (visibility other than 'class') are left out, except
+    the viewer's own and those in `taught_class_ids`.
+    """
+    limit = max(1, min(limit, ACTIVITY_PAGE_LIMIT))
+    query = db.query(models.ActivityEvent)
+    if class_ids is not None:
+        query = query.filter(models.ActivityEvent.class_id.in_(class_ids))
+    if actor_id is not None:
+        query = query.filter(models.ActivityEvent.actor_id == actor_id)
+    if viewer_id is not None:
+        private_assignments = db.query(models.Assignment.id).filter(models.Assignment.visibility != "class")
+        query = query.filter(~(
+            (models.ActivityEvent.event_type == "submission")
+            & (models.ActivityEvent.actor_id != viewer_id)
+            & models.ActivityEvent.object_id.in_(private_assignments)
+            & models.ActivityEvent.class_id.notin_(taught_class_ids or [])
+        ))
+    if before_id is not None:
+        query = query.filter(models.ActivityEvent.id < before_id)
+    events = query.order_by(models.ActivityEvent.id.desc()).limit(limit + 1).all()
+
+    has_more = len(events) > limit
+    events = events[:limit]
+    return {
+        "events": [
+            {
+                "id": event.id,
+                "type": event.event_type,
+                "actor_id": event.actor_id,
+                "class_id": event.class_id,
+                "object_id": event.object_id,
+                "description": ACTIVITY_EVENT_TYPES.get(event.event_type, event.event_type),
+                "timestamp": event.created_at
+            }
+            for event in events
+        ],
+        "next_before_id": events[-1].id if has_more else None
+    }
+
+STUDENT_COUNTERS = (
+    "posts", "comments", "likes_given", "likes_received", "submissions", "on_time_submissions"
+)
+
+def _record_student_activity(
+    db: Session,
+    class_id: int,
+    student_id: int,
+    deltas: dict[str, int],
+    active: bool = True
+) -> None:
+    """Apply counter deltas to the class_student_stats row, inside the caller's transaction.
+
+    `active` stamps last_active_at; pass False when the write was made by
+    someone else (likes received) or undoes earlier activity. Users not
+    enrolled in the class (its teacher, admins) are skipped.
+    """
+    if not membership_index.is_enrolled(db, student_id, class_id):
+        return
+    table = models.ClassStudentStats.__table__
+    now = datetime.now(timezone.utc)
+    updates = {
+        name: func.greatest(table.c[name] + delta, 0)
+        for name, delta in deltas.items() if delta
+    }
+    if active:
+        updates["last_active_at"] = now
+    if not updates:
+        return
+
+    stmt = pg_insert(table).values(
+        class_id=class_id,
+        student_id=student_id,
+        last_active_at=now if active else None,
+        **{name: max(deltas.get(name, 0), 0) for name in STUDENT_COUNTERS}
+    ).on_conflict_do_update(index_elements=["class_id", "student_id"], set_=updates)
+    db.execute(stmt)
+
+def _local_day_expr(column, tz: str, naive_utc: bool = False):
+    """SQL expression for the local day of a timestamp column"""
+    if naive_utc:
+        column = func.timezone("UTC", column)
+    return func.date(func.timezone(tz, column))
+
+def rebuild_class_daily_stats(db: Session, class_ids: List[int] | None = None) -> dict:
+    """Recompute class_daily_stats and class_daily_actors from the source tables.
+
+    Used to backfill the rollup or repair drift; pass `class_ids` to limit
+    the rebuild to some classes.
+    """
+    tz = SCHOOL_TIMEZONE
+    sources = [
+        ("posts", models.Blog.class_id, db.query(
+            models.Blog.class_id,
+            _local_day_expr(models.Blog.created_at, tz),
+            models.Blog.owner_id,
+            func.count()
+        ).select_from(models.Blog)),
+        ("comments", models.Blog.class_id, db.query(
+            models.Blog.class_id,
+            _local_day_expr(models.Comment.created_at, tz, naive_utc=True),
+            models.Comment.user_id,
+            func.count()
+        ).select_from(models.Comment).join(models.Blog, models.Blog.id == models.Comment.blog_id)),
+        ("likes", models.Blog.class_id, db.query(
+            models.Blog.class_id,
+            _local_day_expr(models.PostLike.created_at, tz, naive_utc=True),
+            models.PostLike.user_id,
+            func.count()
+        ).select_from(models.PostLike).join(models.Blog, models.Blog.id == models.PostLike.post_id)),
+        ("likes", models.Blog.class_id, db.query(
+            models.Blog.class_id,
+            _local_day_expr(models.CommentLike.created_at, tz, naive_utc=True),
+            models.CommentLike.user_id,
+            func.count()
+        ).select_from(models.CommentLike)
+            .join(models.Comment, models.Comment.id == models.CommentLike.comment_id)
+            .join(models.Blog, models.Blog.id == models.Comment.blog_id)),
+        ("submissions", models.Assignment.class_id, db.query(
+            models.Assignment.class_id,
+            _local_day_expr(models.AssignmentSubmission.submitted_at, tz),
+            models.AssignmentSubmission.student_id,
+            func.count()
+        ).select_from(models.AssignmentSubmission)
+            .join(models.Assignment, models.Assignment.id == models.AssignmentSubmission.assignment_id)),
+    ]
+
+    stats = {}
+    actors = set()
+    for counter, class_column, query in sources:
+        if class_ids is not None:
+            query = query.filter(class_column.in_(class_ids))
+        rows = query.group_by(literal_column("1"), literal_column("2"), literal_column("3")).all()
+        for class_id, day, user_id, count in rows:
+            row = stats.setdefault((class_id, day), {name: 0 for name in ROLLUP_COUNTERS})
+            row[counter] += count
+            actors.add((class_id, day, user_id))
+
+    # Only students count as active; teachers' writes still count toward the totals
+    actor_ids = list({user_id for _, _, user_id in actors})
+    students = {
+        row.id for row in db.query(models.User.id).filter(
+            models.User.id.in_(actor_ids),
+            models.User.role == models.UserRole.STUDENT
+        ).all()
+    } if actor_ids else set()
+    actors = {actor for actor in actors if actor[2] in students}
+
+    active_students = {}
+    for class_id, day, _ in actors:
+        active_students[(class_id, day)] = active_students.get((class_id, day), 0) + 1
+
+    stats_query = db.query(models.ClassDailyStats)
+    actors_query = db.query(models.ClassDailyActor)
+    if class_ids is not None:
+        stats_query = stats_query.filter(models.ClassDailyStats.class_id.in_(class_ids))
+        actors_query = actors_query.filter(models.ClassDailyActor.class_id.in_(class_ids))
+    stats_query.delete(synchronize_session=False)
+    actors_query.delete(synchronize_session=False)
+
+    if stats:
+        db.execute(models.ClassDailyStats.__table__.insert(), [
+            {
+                "class_id": class_id,
+                "day": day,
+                "active_students": active_students.get((class_id, day), 0),
+                **counts
+            }
+            for (class_id, day), counts in stats.items()
+        ])
+    if actors:
+        db.execute(models.ClassDailyActor.__table__.insert(), [
+            {"class_id": class_id, "day": day, "user_id": user_id}
+            for class_id, day, user_id in actors
+        ])
+    db.commit()
+
+    return {"days": len(stats), "actors": len(actors)}
+
+def rebuild_class_student_stats(db: Session, class_ids: List[int] | None = None) -> dict:
+    """Recompute class_student_stats from the source tables"""
+    post_likes = db.query(
+        models.Blog.class_id, models.PostLike.user_id, models.Blog.owner_id, models.PostLike.created_at
+    ).select_from(models.PostLike).join(models.Blog, models.Blog.id == models.PostLike.post_id)
+    comment_likes = db.query(
+        models.Blog.class_id, models.CommentLike.user_id, models.Comment.user_id, models.CommentLike.created_at
+    ).select_from(models.CommentLike).join(
+        models.Comment, models.Comment.id == models.CommentLike.comment_id
+    ).join(models.Blog, models.Blog.id == models.Comment.blog_id)
+    if class_ids is not None:
+        post_likes = post_likes.filter(models.Blog.class_id.in_(class_ids))
+        comment_likes = comment_likes.filter(models.Blog.class_id.in_(class_ids))
+    post_likes = post_likes.subquery()
+    comment_likes = comment_likes.subquery()
+
+    # (counter, query grouped by class and student, class column to filter on)
+    sources = [
+        ("posts", db.query(
+            models.Blog.class_id, models.Blog.owner_id, func.count(), func.max(models.Blog.created_at)
+        ).select_from(models.Blog), models.Blog.class_id),
+        ("comments", db.query(
+            models.Blog.class_id, models.Comment.user_id, func.count(), func.max(models.Comment.created_at)
+        ).select_from(models.Comment).join(models.Blog, models.Blog.id == models.Comment.blog_id), models.Blog.class_id),
+        ("submissions", db.query(
+            models.Assignment.class_id,
+            models.AssignmentSubmission.student_id,
+            func.count(),
+            func.max(models.AssignmentSubmission.submitted_at)
+        ).select_from(models.AssignmentSubmission).join(
+            models.Assignment, models.Assignment.id == models.AssignmentSubmission.assignment_id
+        ), models.Assignment.class_id),
+        ("on_time_submissions", db.query(
+            models.Assignment.class_id,
+            models.AssignmentSubmission.student_id,
+            func.count(),
+            literal_column("NULL")
+        ).select_from(models.AssignmentSubmission).join(
+            models.Assignment, models.Assignment.id == models.AssignmentSubmission.assignment_id
+        ).filter(models.AssignmentSubmission.is_late == False), models.Assignment.class_id),
+    ]
+    for likes in (post_likes, comment_likes):
+        columns = list(likes.c)
+        sources.append(("likes_given", db.query(
+            columns[0], columns[1], func.count(), func.max(columns[3])
+        ), None))
+        sources.append(("likes_received", db.query(
+            columns[0], columns[2], func.count(), literal_column("NULL")
+        ), None))
+
+    stats = {}
+    for counter, query, class_column in sources:
+        if class_ids is not None and class_column is not None:
+            query = query.filter(class_column.in_(class_ids))
+        rows = query.group_by(literal_column("1"), literal_column("2")).all()
+        for class_id, student_id, count, last_active_at in rows:
+            row = stats.setdefault((class_id, student_id), {
+                **{name: 0 for name in STUDENT_COUNTERS},
+                "last_active_at": None
+            })
+            row[counter] += count
+            if last_active_at is not None:
+                if last_active_at.tzinfo is None:
+                    last_active_at = last_active_at.replace(tzinfo=timezone.utc)
+                if row["last_active_at"] is None or last_active_at > row["last_active_at"]:
+                    row["last_active_at"] = last_active_at
+
+    # Keep enrolled students only; teachers and admins also post and comment
+    enrollments = db.query(models.ClassEnrollment.class_id, models.ClassEnrollment.student_id)
+    if class_ids is not None:
+        enrollments = enrollments.filter(models.ClassEnrollment.class_id.in_(class_ids))
+    enrolled = {tuple(row) for row in enrollments.all()}
+    stats = {key: row for key, row in stats.items() if key in enrolled}
+
+    stats_query = db.query(models.ClassStudentStats)
+    if class_ids is not None:
+        stats_query = stats_query.filter(models.ClassStudentStats.class_id.in_(class_ids))
+    stats_query.delete(synchronize_session=False)
+
+    if stats:
+        db.execute(models.ClassStudentStats.__table__.insert(), [
+            {"class_id": class_id, "student_id": student_id, **counts}
+            for (class_id, student_id), counts in stats.items()
+        ])
+    db.commit()
+
+    return {"students": len(stats)}
 
 @app.get("/api/user/profile")
 async def get_user_profile(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     """Get user profile information"""
     try:
@@ -2183,7 +4687,7 @@ async def get_user_profile(
             "cover_image": current_user.cover_image,
             "avatar_id": current_user.avatar_id,
             "avatar_color": current_user.avatar_color,
-            "class_ids": _get_user_class_ids(db, current_user),
+            "class_ids": access.user_class_ids(),
             "created_at": current_user.created_at
         }
     except Exception as e:
@@ -2193,7 +4697,8 @@ async def get_user_profile(
 async def get_public_user_profile(
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     """Get another user's profile if there is a shared class"""
     target_user = db.query(models.User).filter(models.User.id == user_id).first()
@@ -2201,8 +4706,8 @@ async def get_public_user_profile(
         raise HTTPException(status_code=404, detail="User not found")
 
     if current_user.id != target_user.id and not current_user.is_admin:
-        viewer_classes = set(_get_user_class_ids(db, current_user))
-        target_classes = set(_get_user_class_ids(db, target_user))
+        viewer_classes = set(access.user_class_ids())
+        target_classes = set(access.user_class_ids(target_user))
         if viewer_classes.isdisjoint(target_classes):
             raise HTTPException(status_code=403, detail="Not authorized to view this profile")
 
@@ -2218,7 +4723,7 @@ async def get_public_user_profile(
         "cover_image": target_user.cover_image,
         "avatar_id": target_user.avatar_id,
         "avatar_color": target_user.avatar_color,
-        "class_ids": _get_user_class_ids(db, target_user),
+        "class_ids": access.user_class_ids(target_user),
         "created_at": target_user.created_at
     }
 
@@ -2235,6 +4740,7 @@ async def get_current_user_posts(
         class_ = db.query(models.Class).filter(models.Class.id == post.class_id).first()
         posts_with_class.append({
             **post.__dict__,
+            "content": _sign_media_urls(post.content, f"class:{post.class_id}"),
             "class_name": class_.name if class_ else "Unknown Class"
         })
 
@@ -2244,7 +4750,8 @@ async def get_current_user_posts(
 async def get_user_posts(
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
     """Get another user's posts restricted to shared classes"""
     target_user = db.query(models.User).filter(models.User.id == user_id).first()
@@ -2252,8 +4759,8 @@ async def get_user_posts(
         raise HTTPException(status_code=404, detail="User not found")
 
     if current_user.id != target_user.id and not current_user.is_admin:
-        viewer_classes = set(_get_user_class_ids(db, current_user))
-        target_classes = set(_get_user_class_ids(db, target_user))
+        viewer_classes = set(access.user_class_ids())
+        target_classes = set(access.user_class_ids(target_user))
         shared_classes = viewer_classes.intersection(target_classes)
         if not shared_classes:
             return []
@@ -2269,6 +4776,7 @@ async def get_user_posts(
         class_ = db.query(models.Class).filter(models.Class.id == post.class_id).first()
         posts_with_class.append({
             **post.__dict__,
+            "content": _sign_media_urls(post.content, f"class:{post.class_id}"),
             "class_name": class_.name if class_ else "Unknown Class"
         })
 
@@ -2298,6 +4806,9 @@ async def like_post(
     
     if existing_like:
         # Unlike - remove the like
+        _record_class_activity(db, class_id, None, "likes", delta=-1, moment=existing_like.created_at)
+        _record_student_activity(db, class_id, current_user.id, {"likes_given": -1}, active=False)
+        _record_student_activity(db, class_id, post.owner_id, {"likes_received": -1}, active=False)
         db.delete(existing_like)
         action = "unliked"
     else:
@@ -2307,6 +4818,10 @@ async def like_post(
             user_id=current_user.id
         )
         db.add(new_like)
+        _record_event(db, current_user.id, class_id, "like", post_id)
+        _record_class_activity(db, class_id, current_user, "likes")
+        _record_student_activity(db, class_id, current_user.id, {"likes_given": 1})
+        _record_student_activity(db, class_id, post.owner_id, {"likes_received": 1}, active=False)
         action = "liked"
     
     db.commit()
@@ -2559,6 +5074,10 @@ async def create_comment(
     )
     
     db.add(new_comment)
+    db.flush()
+    _record_event(db, current_user.id, class_id, "comment", new_comment.id)
+    _record_class_activity(db, class_id, current_user, "comments")
+    _record_student_activity(db, class_id, current_user.id, {"comments": 1})
     db.commit()
     db.refresh(new_comment)
     
@@ -2601,8 +5120,12 @@ async def like_comment(
         models.CommentLike.user_id == current_user.id
     ).first()
     
+    class_id = comment.blog.class_id
     if existing_like:
         # Unlike - remove the like
+        _record_class_activity(db, class_id, None, "likes", delta=-1, moment=existing_like.created_at)
+        _record_student_activity(db, class_id, current_user.id, {"likes_given": -1}, active=False)
+        _record_student_activity(db, class_id, comment.user_id, {"likes_received": -1}, active=False)
         db.delete(existing_like)
         action = "unliked"
     else:
@@ -2612,6 +5135,10 @@ async def like_comment(
             user_id=current_user.id
         )
         db.add(new_like)
+        _record_event(db, current_user.id, class_id, "comment_like", comment_id)
+        _record_class_activity(db, class_id, current_user, "likes")
+        _record_student_activity(db, class_id, current_user.id, {"likes_given": 1})
+        _record_student_activity(db, class_id, comment.user_id, {"likes_received": 1}, active=False)
         action = "liked"
     
     db.commit()
@@ -2627,6 +5154,48 @@ async def like_comment(
         "like_count": like_count
     }
 
+@app.get("/api/classes/{class_id}/activity")
+async def get_class_activity(
+    class_id: int,
+    before_id: int | None = None,
+    limit: int = 20,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """Recent activity in a class, newest first, paged with before_id"""
+    access.ensure_class_access(class_id)
+    if current_user.is_admin or access.is_class_teacher(access.get_class_or_404(class_id)):
+        return _list_events(db, before_id, limit, class_ids=[class_id])
+    return _list_events(db, before_id, limit, class_ids=[class_id], viewer_id=current_user.id)
+
+@app.get("/api/user/{user_id}/activity")
+async def get_user_activity(
+    user_id: int,
+    before_id: int | None = None,
+    limit: int = 20,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
+):
+    """A user's activity, newest first, restricted to classes shared with the viewer"""
+    if current_user.id == user_id or current_user.is_admin:
+        return _list_events(db, before_id, limit, actor_id=user_id)
+    
+    target_user = db.query(models.User).filter(models.User.id == user_id).first()
+    if not target_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    shared_classes = set(access.user_class_ids()).intersection(access.user_class_ids(target_user))
+    if not shared_classes:
+        return {"events": [], "next_before_id": None}
+    # A teacher's own class ids are the classes they teach
+    taught = list(shared_classes) if current_user.role == models.UserRole.TEACHER else []
+    return _list_events(
+        db, before_id, limit, class_ids=list(shared_classes), actor_id=user_id,
+        viewer_id=current_user.id, taught_class_ids=taught
+    )
+
 @app.get("/api/classes/{class_id}/students")
 async def get_class_students(
     class_id: int,
@@ -2643,11 +5212,7 @@ async def get_class_students(
             raise HTTPException(status_code=403, detail="Not authorized to access this class")
     elif current_user.role == models.UserRole.STUDENT:
         # Students can access classes they're enrolled in
-        enrollment = db.query(models.ClassEnrollment).filter(
-            models.ClassEnrollment.student_id == current_user.id,
-            models.ClassEnrollment.class_id == class_id
-        ).first()
-        if not enrollment:
+        if not membership_index.is_enrolled(db, current_user.id, class_id):
             raise HTTPException(status_code=403, detail="Not enrolled in this class")
     else:
         raise HTTPException(status_code=403, detail="Not authorized")
@@ -2679,18 +5244,196 @@ async def get_class_students(
     
     return students
 
-# Add this after creating the app
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+@app.get("/uploads/{file_path:path}")
+async def serve_upload(
+    file_path: str,
+    request: Request,
+    size: str = "full",
+    original: bool = False,
+    exp: int | None = None,
+    scope: str | None = None,
+    sig: str | None = None,
+    db: Session = Depends(get_db),
+    current_user: models.User | None = Depends(get_optional_current_user)
+):
+    """Serve an upload by its logical path.
+
+    Images with generated variants are served at `size` (thumb, feed or full,
+    without metadata); the uploaded file itself only with original=true.
+    A signed URL (exp, scope, sig) is its own authorization and is checked
+    without touching the database. Otherwise the caller must be signed in
+    and allowed to see the upload, except for profile and cover images.
+    """
+    _require_clean_upload_path(file_path)
+    signed = sig is not None
+    if signed:
+        if not _verify_media_signature(file_path, request):
+            raise HTTPException(status_code=403, detail="Invalid or expired media URL")
+    elif original and file_path.startswith(MEDIA_PUBLIC_PREFIXES):
+        # The unstripped original (with its EXIF data) is for the owner only
+        reference = _lookup_upload_reference(db, file_path)
+        if current_user is None or not (
+            current_user.is_admin or (reference is not None and reference[3] == current_user.id)
+        ):
+            raise HTTPException(status_code=403, detail="Not authorized to access the original file")
+    elif not file_path.startswith(MEDIA_PUBLIC_PREFIXES):
+        if current_user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        _ensure_upload_access(db, AccessContext(db, current_user), file_path)
+    if size not in IMAGE_VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {', '.join(IMAGE_VARIANT_SIZES)}")
+    resolved = _resolve_upload(db, file_path, None if original else size)
+    if not resolved:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # A stored upload's path never changes content, except an image served
+    # as its original while its variants are still being generated
+    reference = _lookup_upload_reference(db, file_path)
+    variants_pending = reference is not None and not original and reference[4] == "pending"
+    if resolved[2] is None or variants_pending:
+        cache_control = "no-cache"
+    else:
+        max_age = MEDIA_IMMUTABLE_MAX_AGE
+        if signed:
+            max_age = max(0, min(max_age, exp - int(time.time())))
+        # URLs signed for one user (fresh uploads) stay out of shared caches
+        visibility = "private" if signed and scope.startswith("user:") else "public"
+        cache_control = f"{visibility}, max-age={max_age}, immutable"
+    return _upload_file_response(request, resolved, cache_control=cache_control)
+
+@app.get("/api/admin/uploads/stats")
+async def get_upload_dedup_stats(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Disk used by the upload store against what separate copies would take"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    blobs, references, stored_bytes, logical_bytes = db.query(
+        func.count(models.UploadBlob.id),
+        func.coalesce(func.sum(models.UploadBlob.ref_count), 0),
+        func.coalesce(func.sum(models.UploadBlob.size), 0),
+        func.coalesce(func.sum(models.UploadBlob.size * models.UploadBlob.ref_count), 0)
+    ).one()
+    return {
+        "blobs": blobs,
+        "references": int(references),
+        "stored_bytes": int(stored_bytes),
+        "logical_bytes": int(logical_bytes),
+        "saved_bytes": int(logical_bytes - stored_bytes),
+        "dedup_ratio": round(logical_bytes / stored_bytes, 2) if stored_bytes else None
+    }
+
+@app.get("/api/admin/storage/top")
+async def get_top_storage_consumers(
+    scope: str = "user",
+    limit: int = 20,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Largest users or classes by upload bytes, from the running totals"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if scope not in ("user", "class"):
+        raise HTTPException(status_code=400, detail="scope must be 'user' or 'class'")
+    limit = max(1, min(limit, 100))
+
+    usage = db.query(models.StorageUsage).filter(
+        models.StorageUsage.scope == scope
+    ).order_by(models.StorageUsage.bytes.desc()).limit(limit).all()
+    ids = [row.scope_id for row in usage]
+    if scope == "user":
+        names = {
+            user.id: f"{user.first_name} {user.last_name}"
+            for user in db.query(models.User).filter(models.User.id.in_(ids)).all()
+        } if ids else {}
+        quota = USER_STORAGE_QUOTA
+    else:
+        names = dict(
+            db.query(models.Class.id, models.Class.name).filter(models.Class.id.in_(ids)).all()
+        ) if ids else {}
+        quota = CLASS_STORAGE_QUOTA
+
+    return {
+        "scope": scope,
+        "quota_bytes": quota or None,
+        "consumers": [
+            {
+                "id": row.scope_id,
+                "name": names.get(row.scope_id),
+                "bytes": row.bytes,
+                "files": row.files,
+                "quota_used": round(row.bytes / quota, 4) if quota else None,
+                "updated_at": row.updated_at
+            }
+            for row in usage
+        ]
+    }
+
+@app.post("/api/admin/storage/rebuild")
+async def rebuild_storage_usage(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Recompute the storage totals from upload_references"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return await asyncio.to_thread(_run_storage_usage_rebuild)
+
+def _run_storage_usage_rebuild() -> dict:
+    """Rebuild storage_usage in one transaction, holding off uploads and
+    deletes (which take the lock shared) until it commits"""
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": STORAGE_USAGE_LOCK_KEY})
+        db.query(models.StorageUsage).delete(synchronize_session=False)
+        counts = {}
+        for scope, column in (("user", models.UploadReference.user_id), ("class", models.UploadReference.class_id)):
+            rows = db.query(
+                column,
+                func.sum(models.UploadBlob.size),
+                func.count(models.UploadReference.id)
+            ).join(
+                models.UploadBlob, models.UploadBlob.id == models.UploadReference.blob_id
+            ).filter(column.isnot(None)).group_by(column).all()
+            db.add_all([
+                models.StorageUsage(scope=scope, scope_id=scope_id, bytes=int(total), files=count)
+                for scope_id, total, count in rows
+            ])
+            counts[scope] = len(rows)
+        db.commit()
+        return {"users": counts["user"], "classes": counts["class"]}
+    finally:
+        db.close()
 
 @app.delete("/api/upload/{file_path:path}")
 async def delete_file(
     file_path: str,
+    db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
     """Delete an uploaded file"""
     try:
+        _require_clean_upload_path(file_path)
+        reference = db.query(models.UploadReference).filter(
+            models.UploadReference.path == file_path
+        ).first()
+        if reference:
+            if reference.user_id != current_user.id:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="You don't have permission to delete this file"
+                )
+            _release_upload(db, reference)
+            return {"message": "File deleted successfully"}
+
         # Ensure the file belongs to the current user
-        user_dir = f"{current_user.id}"
+        user_dir = f"{current_user.id}/"
         if not file_path.startswith(user_dir):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -2724,13 +5467,19 @@ async def delete_file(
 async def download_file(
     url: str,
     filename: str,
-    current_user: models.User = Depends(get_current_user)
+    request: Request,
+    inline: bool = False,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    access: AccessContext = Depends(get_access_context)
 ):
-    """Force download a file with the specified filename"""
+    """Download a file with the specified filename.
+
+    Supports byte ranges and If-None-Match/If-Modified-Since, so interrupted
+    downloads resume and videos can seek; inline=true lets the browser play
+    the file instead of saving it.
+    """
     try:
-        # Print debug info
-        print(f"Download request - URL: {url}, Filename: {filename}")
-        
         # Extract the file path from the URL
         if url.startswith('http'):
             # Handle full URLs
@@ -2746,26 +5495,22 @@ async def download_file(
         else:
             # Assume it's already a file path
             file_path = url
+        file_path = _require_clean_upload_path(file_path.split('?')[0])
+        _ensure_upload_access(db, access, file_path)
         
-        print(f"Extracted file path: {file_path}")
-        
-        # Construct the full path
-        full_path = Path("uploads") / file_path
-        print(f"Full file path: {full_path}")
-        
-        # Check if file exists
-        if not full_path.exists():
+        # Resolve the logical path to the stored file
+        resolved = _resolve_upload(db, file_path)
+        if not resolved:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"File not found: {full_path}"
+                detail=f"File not found: {file_path}"
             )
         
-        # Return the file as an attachment to force download
-        return FileResponse(
-            path=full_path,
+        return _upload_file_response(
+            request,
+            resolved,
             filename=filename,
-            media_type='application/octet-stream',
-            headers={"Content-Disposition": f"attachment; filename=\"{filename}\""}
+            content_disposition_type="inline" if inline else "attachment"
         )
     except Exception as e:
         if isinstance(e, HTTPException):
@@ -2871,6 +5616,7 @@ async def delete_class(
     # Delete the class
     db.delete(db_class)
     db.commit()
+    membership_index.class_removed(class_id, teacher.id)
     
     return {"message": "Class deleted successfully"}
 
@@ -2916,16 +5662,39 @@ async def get_student_details(
     if not enrollment:
         raise HTTPException(status_code=404, detail="Student not enrolled in this class")
     
-    # Get student's posts in this class
-    posts_count = db.query(models.Blog).filter(
-        models.Blog.owner_id == student_id,
-        models.Blog.class_id == class_id
-    ).count()
+    # Activity metrics come from maintained counters, a single indexed row
+    counters = db.query(models.ClassStudentStats).filter(
+        models.ClassStudentStats.class_id == class_id,
+        models.ClassStudentStats.student_id == student_id
+    ).first()
+    metrics = {name: getattr(counters, name) if counters else 0 for name in STUDENT_COUNTERS}
+    last_active = counters.last_active_at if counters else None
     
-    # For comments and likes, we'll use a simpler approach since we're not sure of the exact model structure
-    # Instead of joining, we'll just return placeholder values
-    comments_count = 0
-    likes_count = 0
+    assignments_total = db.query(models.Assignment).filter(
+        models.Assignment.class_id == class_id
+    ).count()
+    on_time_rate = round(
+        (metrics["on_time_submissions"] / metrics["submissions"]) * 100
+    ) if metrics["submissions"] else None
+    engagement = min(
+        100,
+        round((metrics["submissions"] / assignments_total) * 100)
+    ) if assignments_total else None
+    
+    recent_activity = _list_events(db, None, 10, class_ids=[class_id], actor_id=student_id)["events"]
+    activity_timeline = [{
+        "title": "Joined Class",
+        "description": f"Enrolled in {db_class.name}",
+        "timestamp": enrollment.enrolled_at
+    }] + [
+        {
+            "title": event["type"].capitalize(),
+            "description": event["description"],
+            "timestamp": event["timestamp"]
+        }
+        for event in reversed(recent_activity)
+        if event["type"] != "enrollment"
+    ]
     
     # Return student details with activity metrics
     return {
@@ -2934,52 +5703,19 @@ async def get_student_details(
         "email": student.email,
         "first_name": student.first_name,
         "last_name": student.last_name,
-        "enrollment_date": datetime.utcnow() - timedelta(days=30),  # Placeholder since enrollment.created_at doesn't exist
-        "posts_count": posts_count,
-        "comments_count": comments_count,
-        "likes_count": likes_count,
+        "enrollment_date": enrollment.enrolled_at,
+        "posts_count": metrics["posts"],
+        "comments_count": metrics["comments"],
+        "likes_count": metrics["likes_given"],
+        "likes_received": metrics["likes_received"],
+        "submissions_count": metrics["submissions"],
+        "assignments_total": assignments_total,
+        "on_time_rate": on_time_rate,
+        "last_active": last_active,
         "teacher_notes": enrollment.notes if hasattr(enrollment, 'notes') else None,
-        # Sample data for the UI - in a real app, you'd compute these from actual data
-        "engagement_score": "85%",
-        "recent_activity": [
-            {
-                "type": "post",
-                "description": "Created a new post: 'Understanding Variables in Python'",
-                "timestamp": datetime.utcnow() - timedelta(days=2, hours=3)
-            },
-            {
-                "type": "comment",
-                "description": "Commented on 'Introduction to Data Structures'",
-                "timestamp": datetime.utcnow() - timedelta(days=3, hours=7)
-            },
-            {
-                "type": "like",
-                "description": "Liked 'JavaScript Fundamentals'",
-                "timestamp": datetime.utcnow() - timedelta(days=4, hours=12)
-            }
-        ],
-        "activity_timeline": [
-            {
-                "title": "Joined Class",
-                "description": f"Enrolled in {db_class.name}",
-                "timestamp": datetime.utcnow() - timedelta(days=30)  # Placeholder
-            },
-            {
-                "title": "First Post",
-                "description": "Created first blog post",
-                "timestamp": datetime.utcnow() - timedelta(days=15)
-            },
-            {
-                "title": "Completed Assignment",
-                "description": "Submitted the Python basics assignment",
-                "timestamp": datetime.utcnow() - timedelta(days=10)
-            },
-            {
-                "title": "Active Participation",
-                "description": "Commented on 5 different posts",
-                "timestamp": datetime.utcnow() - timedelta(days=5)
-            }
-        ]
+        "engagement_score": f"{engagement}%" if engagement is not None else "N/A",
+        "recent_activity": recent_activity,
+        "activity_timeline": activity_timeline
     }
 
 @app.get("/api/classes/{class_id}/students/{student_id}/posts")
@@ -3016,26 +5752,34 @@ async def get_student_posts(
         models.Blog.class_id == class_id
     ).order_by(models.Blog.created_at.desc()).all()
     
+    # Count likes and comments for all posts at once
+    post_ids = [post.id for post in posts]
+    likes_by_post = {}
+    comments_by_post = {}
+    if post_ids:
+        likes_by_post = dict(db.query(
+            models.PostLike.post_id,
+            func.count(models.PostLike.id)
+        ).filter(
+            models.PostLike.post_id.in_(post_ids)
+        ).group_by(models.PostLike.post_id).all())
+        comments_by_post = dict(db.query(
+            models.Comment.blog_id,
+            func.count(models.Comment.id)
+        ).filter(
+            models.Comment.blog_id.in_(post_ids)
+        ).group_by(models.Comment.blog_id).all())
+    
     # Format posts with additional information
     formatted_posts = []
     for post in posts:
-        # Count likes
-        likes_count = db.query(models.Like).filter(
-            models.Like.post_id == post.id
-        ).count()
-        
-        # Count comments
-        comments_count = db.query(models.Comment).filter(
-            models.Comment.post_id == post.id
-        ).count()
-        
         formatted_posts.append({
             "id": post.id,
             "title": post.title,
-            "content": post.content,
+            "content": _sign_media_urls(post.content, f"class:{class_id}"),
             "created_at": post.created_at,
-            "likes": likes_count,
-            "comments": comments_count
+            "likes": likes_by_post.get(post.id, 0),
+            "comments": comments_by_post.get(post.id, 0)
         })
     
     return formatted_posts
@@ -3103,6 +5847,121 @@ EMAIL_USERNAME = os.getenv("EMAIL_USERNAME")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_FROM = os.getenv("EMAIL_FROM")
 
+# Password reset token housekeeping
+PASSWORD_RESET_MAX_OUTSTANDING = int(os.getenv("PASSWORD_RESET_MAX_OUTSTANDING", "3"))
+PASSWORD_RESET_SWEEP_INTERVAL = int(os.getenv("PASSWORD_RESET_SWEEP_INTERVAL", "900"))
+PASSWORD_RESET_SWEEP_BATCH = int(os.getenv("PASSWORD_RESET_SWEEP_BATCH", "500"))
+
+def _sweep_password_resets(db: Session, batch_size: int = PASSWORD_RESET_SWEEP_BATCH) -> int:
+    """Delete expired or used reset tokens in bounded batches, returns rows removed.
+
+    Used and expired tokens are swept separately, so each pass is a range
+    scan on the (used, expires_at) index rather than an OR over both.
+    """
+    removed = 0
+    now = datetime.utcnow()
+    for condition in (
+        PasswordReset.used == True,
+        (PasswordReset.used == False) & (PasswordReset.expires_at <= now),
+    ):
+        while True:
+            ids = [
+                row.id
+                for row in db.query(PasswordReset.id).filter(condition).limit(batch_size).all()
+            ]
+            if not ids:
+                break
+            db.query(PasswordReset).filter(PasswordReset.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            removed += len(ids)
+            if len(ids) < batch_size:
+                break
+    return removed
+
+def _run_password_reset_sweep() -> int:
+    db = SessionLocal()
+    try:
+        return _sweep_password_resets(db)
+    finally:
+        db.close()
+
+UPLOAD_SESSION_SWEEP_INTERVAL = int(os.getenv("UPLOAD_SESSION_SWEEP_INTERVAL", "3600"))
+
+def _sweep_upload_sessions(db: Session) -> int:
+    """Delete expired resumable uploads and their part files, returns sessions removed"""
+    expired = db.query(models.UploadSession).filter(
+        models.UploadSession.expires_at <= datetime.now(timezone.utc)
+    ).with_for_update(skip_locked=True).all()
+    for session in expired:
+        _upload_session_path(session.id).unlink(missing_ok=True)
+        db.delete(session)
+    db.commit()
+    return len(expired)
+
+def _run_upload_session_sweep() -> int:
+    db = SessionLocal()
+    try:
+        return _sweep_upload_sessions(db)
+    finally:
+        db.close()
+
+async def _run_periodically(name: str, interval: int, job):
+    """Run a blocking housekeeping job off the event loop every `interval` seconds"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(job)
+            if removed:
+                print(f"{name} removed {removed} rows")
+        except Exception as e:
+            print(f"{name} error: {str(e)}")
+        await asyncio.sleep(interval)
+
+# Activity event retention: everything goes after ACTIVITY_RETENTION_DAYS, likes
+# are compacted away earlier since timelines only show recent ones
+ACTIVITY_RETENTION_DAYS = int(os.getenv("ACTIVITY_RETENTION_DAYS", "365"))
+ACTIVITY_LIKE_RETENTION_DAYS = int(os.getenv("ACTIVITY_LIKE_RETENTION_DAYS", "30"))
+ACTIVITY_COMPACTION_INTERVAL = int(os.getenv("ACTIVITY_COMPACTION_INTERVAL", "3600"))
+ACTIVITY_COMPACTION_BATCH = int(os.getenv("ACTIVITY_COMPACTION_BATCH", "1000"))
+
+def _compact_activity_events(db: Session, batch_size: int = ACTIVITY_COMPACTION_BATCH) -> int:
+    """Delete expired activity events in bounded batches, returns rows removed"""
+    now = datetime.now(timezone.utc)
+    expired = (
+        (models.ActivityEvent.created_at < now - timedelta(days=ACTIVITY_RETENTION_DAYS))
+        | (
+            models.ActivityEvent.event_type.in_(("like", "comment_like"))
+            & (models.ActivityEvent.created_at < now - timedelta(days=ACTIVITY_LIKE_RETENTION_DAYS))
+        )
+    )
+    removed = 0
+    while True:
+        ids = [row.id for row in db.query(models.ActivityEvent.id).filter(expired).limit(batch_size).all()]
+        if not ids:
+            break
+        db.query(models.ActivityEvent).filter(models.ActivityEvent.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        removed += len(ids)
+        if len(ids) < batch_size:
+            break
+    return removed
+
+def _run_activity_compaction() -> int:
+    db = SessionLocal()
+    try:
+        return _compact_activity_events(db)
+    finally:
+        db.close()
+
+def _cap_outstanding_resets(db: Session, user_id: int, keep: int) -> None:
+    """Invalidate the oldest live tokens so at most `keep` remain for the user"""
+    stale = db.query(PasswordReset).filter(
+        PasswordReset.user_id == user_id,
+        PasswordReset.used == False,
+        PasswordReset.expires_at > datetime.utcnow()
+    ).order_by(PasswordReset.created_at.desc(), PasswordReset.id.desc()).offset(keep).all()
+    for password_reset in stale:
+        password_reset.used = True
+
 
 def send_password_reset_email(email: str, token: str):
     """Send password reset email with reset link"""
@@ -3173,6 +6032,9 @@ async def forgot_password(request: ForgotPasswordRequest, db: Session = Depends(
     if not user:
         raise HTTPException(status_code=404, detail="No account found with this email address")
     
+    # Keep room for the new token within the per-user cap
+    _cap_outstanding_resets(db, user.id, keep=max(PASSWORD_RESET_MAX_OUTSTANDING - 1, 0))
+    
     # Create a secure token
     token = secrets.token_urlsafe(32)
     expires_at = datetime.utcnow() + timedelta(hours=1)
@@ -3232,5 +6094,55 @@ async def reset_password(request: ResetPasswordRequest, db: Session = Depends(ge
     
     return {"message": "Password reset successfully"}
 
+@app.post("/api/admin/rollups/rebuild")
+async def rebuild_rollups(
+    rebuild_data: dict | None = None,
+    current_user: models.User = Depends(get_current_user)
+):
+    """Backfill or repair the analytics rollup tables (admins only)"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    class_ids = (rebuild_data or {}).get("class_ids")
+    return await asyncio.to_thread(_run_rollup_rebuild, class_ids)
+
+def _run_rollup_rebuild(class_ids: List[int] | None = None) -> dict:
+    db = SessionLocal()
+    try:
+        return {
+            "class_daily_stats": rebuild_class_daily_stats(db, class_ids),
+            "class_student_stats": rebuild_class_student_stats(db, class_ids)
+        }
+    finally:
+        db.close()
+
+@app.post("/api/admin/class-daily-stats/rebuild")
+async def rebuild_class_daily_stats_endpoint(
+    rebuild_data: dict | None = None,
+    current_user: models.User = Depends(get_current_user)
+):
+    """Backfill or repair the class_daily_stats rollup only (admins only);
+    kept for existing callers, /api/admin/rollups/rebuild covers both rollups"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    class_ids = (rebuild_data or {}).get("class_ids")
+    return await asyncio.to_thread(_run_class_daily_stats_rebuild, class_ids)
+
+def _run_class_daily_stats_rebuild(class_ids: List[int] | None = None) -> dict:
+    db = SessionLocal()
+    try:
+        return rebuild_class_daily_stats(db, class_ids)
+    finally:
+        db.close()
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    import sys
+    if sys.argv[1:2] == ["rebuild-rollups"]:
+        # python main.py rebuild-rollups
+        print(_run_rollup_rebuild())
+    elif sys.argv[1:2] == ["rebuild-daily-stats"]:
+        # python main.py rebuild-daily-stats (class_daily_stats only)
+        print(_run_class_daily_stats_rebuild())
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
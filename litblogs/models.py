@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, func, Enum as SQLAlchemyEnum, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey, func, Enum as SQLAlchemyEnum, Boolean, UniqueConstraint, Index, LargeBinary, JSON, BigInteger
 from sqlalchemy.orm import relationship
 from base import Base
 from enum import Enum
@@ -74,6 +74,11 @@ class Assignment(Base):
     class_ = relationship("Class", back_populates="assignments")
     submissions = relationship("AssignmentSubmission", back_populates="assignment", cascade="all, delete-orphan")
 
+    # Serves per-class listings and cross-class deadline lookups by due date
+    __table_args__ = (
+        Index('ix_assignments_class_due', 'class_id', 'due_date'),
+    )
+
 class AssignmentSubmission(Base):
     __tablename__ = "assignment_submissions"
     id = Column(Integer, primary_key=True, index=True)
@@ -86,15 +91,25 @@ class AssignmentSubmission(Base):
     assignment = relationship("Assignment", back_populates="submissions")
     student = relationship("User", back_populates="assignment_submissions")
 
+    # One submission per student per assignment, resubmissions update it
+    __table_args__ = (
+        UniqueConstraint('assignment_id', 'student_id', name='unique_assignment_submission'),
+    )
+
 class ClassEnrollment(Base):
     __tablename__ = "class_enrollments"
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    class_id = Column(Integer, ForeignKey("classes.id"), nullable=False)
+    class_id = Column(Integer, ForeignKey("classes.id"), nullable=False, index=True)
     enrolled_at = Column(DateTime(timezone=True), server_default=func.now())
     student = relationship("User", back_populates="enrolled_classes")
     class_ = relationship("Class", back_populates="students")
 
+    # A student can only be enrolled in a class once
+    __table_args__ = (
+        UniqueConstraint('student_id', 'class_id', name='unique_class_enrollment'),
+    )
+
 class Blog(Base):
     __tablename__ = "blogs"
     id = Column(Integer, primary_key=True, index=True)
@@ -108,6 +123,11 @@ class Blog(Base):
     likes = relationship("PostLike", back_populates="post", cascade="all, delete-orphan")
     comments = relationship("Comment", back_populates="blog")
 
+    # Serves the rolling posts-in-the-last-week count per class
+    __table_args__ = (
+        Index('ix_blogs_class_id_created_at', 'class_id', 'created_at'),
+    )
+
 class PostLike(Base):
     __tablename__ = "post_likes"
     
@@ -165,6 +185,145 @@ class CommentLike(Base):
         UniqueConstraint('comment_id', 'user_id', name='unique_comment_like'),
     )
 
+class ClassDailyStats(Base):
+    __tablename__ = "class_daily_stats"
+
+    id = Column(Integer, primary_key=True, index=True)
+    class_id = Column(Integer, ForeignKey("classes.id", ondelete="CASCADE"), nullable=False)
+    day = Column(Date, nullable=False)  # Local school day (SCHOOL_TIMEZONE)
+    posts = Column(Integer, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+    likes = Column(Integer, nullable=False, default=0)
+    submissions = Column(Integer, nullable=False, default=0)
+    active_students = Column(Integer, nullable=False, default=0)
+
+    # One rollup row per class per day
+    __table_args__ = (
+        UniqueConstraint('class_id', 'day', name='unique_class_daily_stats'),
+    )
+
+class ClassDailyActor(Base):
+    __tablename__ = "class_daily_actors"
+
+    id = Column(Integer, primary_key=True, index=True)
+    class_id = Column(Integer, ForeignKey("classes.id", ondelete="CASCADE"), nullable=False)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+
+    # Tracks who was active so active_students counts each student once per day
+    __table_args__ = (
+        UniqueConstraint('class_id', 'day', 'user_id', name='unique_class_daily_actor'),
+    )
+
+class ClassStudentStats(Base):
+    __tablename__ = "class_student_stats"
+
+    id = Column(Integer, primary_key=True, index=True)
+    class_id = Column(Integer, ForeignKey("classes.id", ondelete="CASCADE"), nullable=False)
+    student_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    posts = Column(Integer, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+    likes_given = Column(Integer, nullable=False, default=0)
+    likes_received = Column(Integer, nullable=False, default=0)
+    submissions = Column(Integer, nullable=False, default=0)
+    on_time_submissions = Column(Integer, nullable=False, default=0)
+    last_active_at = Column(DateTime(timezone=True), nullable=True)
+
+    # One counter row per student per class
+    __table_args__ = (
+        UniqueConstraint('class_id', 'student_id', name='unique_class_student_stats'),
+    )
+
+class SubmissionRevision(Base):
+    __tablename__ = "submission_revisions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    submission_id = Column(Integer, ForeignKey("assignment_submissions.id", ondelete="CASCADE"), nullable=False)
+    revision = Column(Integer, nullable=False)  # 1, 2, ... per submission
+    kind = Column(String(10), nullable=False)  # 'snapshot' (full text) or 'delta' (against the previous revision)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed text or delta ops
+    raw_size = Column(Integer, nullable=False)  # UTF-8 bytes of the reconstructed text
+    submitted_at = Column(DateTime(timezone=True), nullable=False)
+    is_late = Column(Boolean, default=False)
+
+    __table_args__ = (
+        UniqueConstraint('submission_id', 'revision', name='unique_submission_revision'),
+    )
+
+class UploadBlob(Base):
+    """Stored file content, kept once per distinct SHA-256 under uploads/blobs"""
+    __tablename__ = "upload_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String(100), nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0)  # number of upload_references rows
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class UploadReference(Base):
+    """A user's upload: the logical path its URL uses, mapped to a blob"""
+    __tablename__ = "upload_references"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # No cascade: references go through _release_upload, which keeps blob ref counts and storage usage in step
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    blob_id = Column(Integer, ForeignKey("upload_blobs.id"), nullable=False, index=True)
+    path = Column(String(500), unique=True, nullable=False)  # relative to /uploads/
+    class_id = Column(Integer, ForeignKey("classes.id", ondelete="SET NULL"), nullable=True)  # class it was uploaded for, if given
+    filename = Column(String(255), nullable=True)  # as uploaded
+    variants = Column(JSON, nullable=True)  # image variant name -> logical path of its own reference
+    variant_state = Column(String(10), nullable=False, default="none")  # none, pending, ready or failed
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class StorageUsage(Base):
+    """Running totals of upload bytes per user and per class, kept in step
+    with upload_references; a user is charged for every reference, deduplicated or not"""
+    __tablename__ = "storage_usage"
+
+    id = Column(Integer, primary_key=True, index=True)
+    scope = Column(String(10), nullable=False)  # 'user' or 'class'
+    scope_id = Column(Integer, nullable=False)  # users.id or classes.id
+    bytes = Column(BigInteger, nullable=False, default=0)
+    files = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('scope', 'scope_id', name='unique_storage_usage_scope'),
+        Index('ix_storage_usage_scope_bytes', 'scope', 'bytes'),
+    )
+
+class UploadSession(Base):
+    """A resumable upload in progress; its bytes live in uploads/temp/<id>.part"""
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    filename = Column(String(255), nullable=False)
+    content_type = Column(String(100), nullable=True)
+    size = Column(BigInteger, nullable=False)  # declared total
+    received = Column(BigInteger, nullable=False, default=0)  # next offset expected
+    claimed_until = Column(DateTime(timezone=True), nullable=True)  # set while a chunk streams in
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)  # pushed back by each chunk
+
+class ActivityEvent(Base):
+    __tablename__ = "activity_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    actor_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    class_id = Column(Integer, ForeignKey("classes.id", ondelete="CASCADE"), nullable=False)
+    event_type = Column(String(20), nullable=False)  # 'post', 'comment', 'like', 'comment_like', 'submission', 'enrollment'
+    object_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    # Append-only, so id order is time order; these serve keyset pages per class and per user
+    __table_args__ = (
+        Index('ix_activity_events_class_id_id', 'class_id', 'id'),
+        Index('ix_activity_events_actor_id_id', 'actor_id', 'id'),
+        Index('ix_activity_events_created_at', 'created_at'),
+    )
+
 class PasswordReset(Base):
     __tablename__ = "password_resets"
     id = Column(Integer, primary_key=True, index=True)
@@ -172,4 +331,10 @@ class PasswordReset(Base):
     token = Column(String(64), unique=True, nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     expires_at = Column(DateTime(timezone=True), nullable=False)
-    used = Column(Boolean, default=False)
\ No newline at end of file
+    used = Column(Boolean, default=False)
+
+    # Serves both the per-user outstanding token lookup and the expiry sweep
+    __table_args__ = (
+        Index('ix_password_resets_user_used_expires', 'user_id', 'used', 'expires_at'),
+        Index('ix_password_resets_used_expires', 'used', 'expires_at'),
+    )
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Shared fixtures for the API tests.
+
+The app needs Postgres (upserts, advisory locks), so the tests run against
+the scratch database in TEST_DATABASE_URL, which is dropped and recreated
+for every test. Without it they are skipped.
+"""
+import os
+import secrets
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("SECRET_KEY", "test-secret")
+if os.getenv("TEST_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    if not os.getenv("TEST_DATABASE_URL"):
+        pytest.skip("set TEST_DATABASE_URL to a scratch Postgres database")
+    # main creates its uploads/ tree in the working directory on import
+    os.chdir(tmp_path_factory.mktemp("app"))
+    import main
+    return main
+
+
+@pytest.fixture
+def db(app_module):
+    app_module.reset_database()
+    app_module.membership_index.clear()
+    session = app_module.SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def client(app_module, db):
+    from fastapi.testclient import TestClient
+    # Not entered as a context manager, so the lifespan (which resets the
+    # database and starts housekeeping tasks) does not run
+    return TestClient(app_module.app)
+
+
+class QueryCounter:
+    """SQL statements sent through the engine while counting"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def touching(self, table: str) -> list[str]:
+        return [statement for statement in self.statements if f"FROM {table}" in statement]
+
+
+@pytest.fixture
+def count_queries(app_module):
+    @contextmanager
+    def counting():
+        counter = QueryCounter()
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            counter.statements.append(statement)
+
+        event.listen(app_module.engine, "before_cursor_execute", record)
+        try:
+            yield counter
+        finally:
+            event.remove(app_module.engine, "before_cursor_execute", record)
+
+    return counting
+
+
+@pytest.fixture
+def make_user(app_module, db):
+    """Create a user (and a teacher record for teachers); returns (user, auth headers)"""
+    models = app_module.models
+
+    def make(role=models.UserRole.STUDENT):
+        name = f"{role.value.lower()}-{secrets.token_hex(4)}"
+        user = models.User(username=name, email=f"{name}@example.com", password="x", role=role)
+        db.add(user)
+        db.flush()
+        if role == models.UserRole.TEACHER:
+            db.add(models.Teacher(name=name, email=user.email, user_id=user.id))
+        db.commit()
+        token = app_module.create_access_token(data={"sub": str(user.id)})
+        return user, {"Authorization": f"Bearer {token}"}
+
+    return make
+
+
+@pytest.fixture
+def make_class(app_module, db):
+    """Create a class taught by `teacher_user`, with `students` enrolled"""
+    models = app_module.models
+
+    def make(teacher_user, students=()):
+        teacher = db.query(models.Teacher).filter(models.Teacher.user_id == teacher_user.id).one()
+        class_ = models.Class(name="Class", access_code=secrets.token_hex(3).upper(), teacher_id=teacher.id)
+        db.add(class_)
+        db.flush()
+        for student in students:
+            db.add(models.ClassEnrollment(student_id=student.id, class_id=class_.id))
+        db.commit()
+        return class_
+
+    return make
+
+
+@pytest.fixture
+def add_class_with_activity(app_module, db, make_user, make_class):
+    """Create a class for `teacher_user` with two students, a post each, an
+    assignment and one submission"""
+    models = app_module.models
+
+    def add(teacher_user):
+        students = [make_user()[0] for _ in range(2)]
+        class_ = make_class(teacher_user, students)
+        assignment = models.Assignment(
+            class_id=class_.id,
+            title="Essay",
+            due_date=datetime.now(timezone.utc) + timedelta(days=3),
+            created_by=teacher_user.id
+        )
+        db.add(assignment)
+        db.flush()
+        for student in students:
+            db.add(models.Blog(title="Post", content="<p>Hello</p>", owner_id=student.id, class_id=class_.id))
+        db.add(models.AssignmentSubmission(assignment_id=assignment.id, student_id=students[0].id, content="Done"))
+        db.commit()
+        return class_
+
+    return add
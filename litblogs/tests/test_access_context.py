@@ -0,0 +1,56 @@
+"""Each authorization fact is loaded at most once per request"""
+from fastapi import Depends
+
+
+def test_request_loads_each_fact_once(app_module, client, db, make_user, make_class, count_queries):
+    models = app_module.models
+    teacher, headers = make_user(models.UserRole.TEACHER)
+    student, _ = make_user()
+    class_ = make_class(teacher, [student])
+
+    # Keep the request's AccessContext to read its load counters
+    contexts = []
+
+    def recording_access_context(
+        db=Depends(app_module.get_db),
+        current_user=Depends(app_module.get_current_user)
+    ):
+        context = app_module.AccessContext(db, current_user)
+        contexts.append(context)
+        return context
+
+    app_module.app.dependency_overrides[app_module.get_access_context] = recording_access_context
+    try:
+        with count_queries() as queries:
+            # ensure_class_access, then is_class_teacher(get_class_or_404) again
+            response = client.get(f"/api/classes/{class_.id}/activity", headers=headers)
+    finally:
+        app_module.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    (context,) = contexts
+    assert context.loads == {"class_access": 1, "class": 1, "teacher": 1}
+    assert len(queries.touching("classes")) == 1
+    assert len(queries.touching("teachers")) == 1
+
+
+def test_repeated_lookups_hit_the_memo(app_module, db, make_user, make_class, count_queries):
+    models = app_module.models
+    teacher, _ = make_user(models.UserRole.TEACHER)
+    class_ = make_class(teacher)
+    access = app_module.AccessContext(db, teacher)
+
+    with count_queries() as first:
+        access.ensure_class_access(class_.id)
+        access.user_class_ids()
+    with count_queries() as again:
+        for _ in range(3):
+            access.ensure_class_access(class_.id)
+            access.get_class_or_404(class_.id)
+            access.is_class_teacher(access.get_class_or_404(class_.id))
+            access.teacher()
+            access.user_class_ids()
+
+    assert len(first) > 0
+    assert len(again) == 0
+    assert all(count == 1 for count in access.loads.values())
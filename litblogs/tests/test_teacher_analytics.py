@@ -0,0 +1,34 @@
+"""Teacher analytics are computed with a fixed number of queries however many classes there are"""
+
+
+def fetch_uncached(app_module, client, headers):
+    # Force a fresh computation instead of the cached snapshot
+    app_module.analytics_cache.invalidate()
+    app_module.membership_index.clear()
+    response = client.get("/api/teacher/analytics", headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_analytics_queries_stay_flat_as_classes_are_added(
+    app_module, client, make_user, add_class_with_activity, count_queries
+):
+    teacher, headers = make_user(app_module.models.UserRole.TEACHER)
+    add_class_with_activity(teacher)
+
+    # The snapshot is computed on a worker thread; the counter sees every
+    # statement sent through the engine
+    with count_queries() as one_class:
+        report = fetch_uncached(app_module, client, headers)
+    assert report["totals"]["classes"] == 1
+
+    for _ in range(4):
+        add_class_with_activity(teacher)
+
+    with count_queries() as five_classes:
+        report = fetch_uncached(app_module, client, headers)
+    assert report["totals"]["classes"] == 5
+    assert report["totals"]["students"] == 10
+
+    assert len(one_class) > 0
+    assert len(five_classes) == len(one_class)
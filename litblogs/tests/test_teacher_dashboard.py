@@ -0,0 +1,25 @@
+"""The teacher dashboard's query count does not grow with the number of classes"""
+
+
+def test_dashboard_queries_stay_flat_as_classes_are_added(
+    app_module, client, make_user, add_class_with_activity, count_queries
+):
+    teacher, headers = make_user(app_module.models.UserRole.TEACHER)
+    add_class_with_activity(teacher)
+
+    with count_queries() as one_class:
+        response = client.get("/api/teacher/dashboard", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()["classes"]) == 1
+
+    for _ in range(4):
+        add_class_with_activity(teacher)
+    # Same cache state as the first request
+    app_module.membership_index.clear()
+
+    with count_queries() as five_classes:
+        response = client.get("/api/teacher/dashboard", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()["classes"]) == 5
+
+    assert len(five_classes) == len(one_class)
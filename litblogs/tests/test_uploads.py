@@ -0,0 +1,58 @@
+"""Access checks and URLs for stored uploads"""
+import html
+import re
+from urllib.parse import quote
+
+
+def write_legacy_upload(app_module, user, name, data=b"secret"):
+    """A file in the per-user layout from before the upload store"""
+    directory = app_module.UPLOAD_DIR / str(user.id)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / name).write_bytes(data)
+    return f"{user.id}/{name}"
+
+
+def test_dot_segments_cannot_reach_another_users_files(app_module, client, make_user):
+    attacker, headers = make_user()
+    victim, victim_headers = make_user()
+    path = write_legacy_upload(app_module, victim, "secret.pdf")
+
+    assert client.get(f"/uploads/{path}", headers=victim_headers).status_code == 200
+    assert client.get(f"/uploads/{path}", headers=headers).status_code == 403
+
+    traversal = f"{attacker.id}/../{path}"
+    assert client.get(f"/uploads/{attacker.id}/..%2F{path}", headers=headers).status_code == 400
+    assert client.get("/api/download", params={"url": traversal, "filename": "x.pdf"}, headers=headers).status_code == 400
+    assert client.get(f"/uploads/{attacker.id}/..%2Fblobs/00/00", headers=headers).status_code == 400
+
+
+def test_filename_with_a_space_gets_a_working_signed_url(app_module, client, make_user):
+    _, headers = make_user()
+    response = client.post(
+        "/api/upload/file",
+        files={"file": ("my photo.txt", b"hello", "text/plain")},
+        headers=headers
+    )
+    assert response.status_code == 200
+    url = response.json()["url"]
+    assert " " not in url and "%20" not in url
+
+    # Signed URLs need no bearer token
+    served = client.get(url)
+    assert served.status_code == 200
+    assert served.content == b"hello"
+
+
+def test_signed_urls_in_content_survive_spaces_in_stored_names(app_module, client, make_user):
+    user, _ = make_user()
+    path = write_legacy_upload(app_module, user, "my photo.txt", b"hello")
+    content = f'<p><img src="/uploads/{path}"> and [FILE:/uploads/{quote(path)}|my photo.txt]</p>'
+
+    signed = app_module._sign_media_urls(content, f"user:{user.id}")
+    urls = [html.unescape(url) for url in re.findall(r"/uploads/[^\"|\s]+", signed)]
+    assert len(urls) == 2
+    for url in urls:
+        assert " " not in url
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.content == b"hello"